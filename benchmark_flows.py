@@ -0,0 +1,260 @@
+"""
+ANYTIME ASSISTANT - BENCHMARKS FOR THE CHATBOT FLOWS
+"""
+
+#Drives every chatbot flow through the conversation engine with scripted answers, against the bundled datasets and synthetic
+#copies scaled up 10x, 100x and 1000x, and prints the p50/p99 latency, peak memory and throughput of each flow as JSON.
+#wger is replaced by the fake wger server and SMTP by the local SMTP sink, both running inside the benchmark process.
+#
+#   python benchmark_flows.py                                   all scales, 50 iterations per flow
+#   python benchmark_flows.py --scales 1,10 --iterations 20 --output bench_output.txt
+#
+#Every scale runs in its own process so caches, loaded models and peak memory do not carry over between scales
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+CHATBOT_DIR = os.path.dirname(os.path.abspath(__file__))
+CHATBOT_MODULE = 'insy660_merged_v4'
+
+DEFAULT_SCALES = [1, 10, 100, 1000]
+DEFAULT_ITERATIONS = 50
+
+#The occupancy history is only used to train the model, it is copied at most this many times so the 1000x dataset stays trainable
+OCCUPANCY_MAX_COPIES = 10
+
+#Data files copied unchanged into every synthetic dataset
+UNSCALED_FILES = ['zipcode_master.xlsx']
+
+
+#1. Function to build a synthetic copy of the bundled datasets in folder, with every gym, member, trainer, review and faq
+# repeated scale times under new ids. Copies of gyms are moved slightly so they do not share coordinates
+
+def build_dataset(scale, folder):
+    rng = np.random.default_rng(42)
+    source = lambda name: os.path.join(CHATBOT_DIR, name)
+    target = lambda name: os.path.join(folder, name)
+    copies = range(scale)
+
+    gyms = pd.read_excel(source('gym_data.xlsx'))
+    gym_count = len(gyms)
+    gyms = pd.concat([gyms.assign(gymId=gyms['gymId'] + copy * gym_count) for copy in copies], ignore_index=True)
+    if scale > 1:
+        gyms['lat'] += rng.normal(0, 0.05, len(gyms))
+        gyms['long'] += rng.normal(0, 0.05, len(gyms))
+    gyms.to_excel(target('gym_data.xlsx'), index=False)
+
+    members = pd.read_excel(source('user_data.xlsx'))
+    usage = pd.read_csv(source('gym_usage_2.csv'))
+    member_count = len(members)
+    member_number = lambda ids, copy: 'gym_' + (ids.str.split('_').str[1].astype(int) + copy * member_count).astype(str)
+    pd.concat([members.assign(customerId=member_number(members['customerId'], copy)) for copy in copies],
+              ignore_index=True).to_excel(target('user_data.xlsx'), index=False)
+    pd.concat([usage.assign(customerId=member_number(usage['customerId'], copy)) for copy in copies],
+              ignore_index=True).to_csv(target('gym_usage_2.csv'), index=False)
+
+    trainers = pd.read_csv(source('gym_trainers_dataset.csv'))
+    reviews = pd.read_csv(source('gym_trainer_reviews.csv'))
+    trainer_count = len(trainers)
+    trainer_number = lambda names, copy: 'Trainer' + (names.str.replace('Trainer', '').astype(int) + copy * trainer_count).astype(str)
+    pd.concat([trainers.assign(Name=trainer_number(trainers['Name'], copy)) for copy in copies],
+              ignore_index=True).to_csv(target('gym_trainers_dataset.csv'), index=False)
+    pd.concat([reviews.assign(Trainer=trainer_number(reviews['Trainer'], copy),
+                              Review=reviews['Review'].str.replace('Trainer ', f'Trainer #{copy} ', regex=False)) for copy in copies],
+              ignore_index=True).to_csv(target('gym_trainer_reviews.csv'), index=False)
+
+    occupancy = pd.read_csv(source('gym_occupancy.csv'))
+    pd.concat([occupancy.assign(gymId=occupancy['gymId'] + copy * gym_count) for copy in range(min(scale, OCCUPANCY_MAX_COPIES))],
+              ignore_index=True).to_csv(target('gym_occupancy.csv'), index=False)
+
+    faqs = pd.read_csv(source('gym_faq.csv'))
+    pd.concat([faqs.assign(topic=faqs['topic'] + (f'-{copy}' if copy else '')) for copy in copies],
+              ignore_index=True).to_csv(target('gym_faq.csv'), index=False)
+
+    for name in UNSCALED_FILES:
+        shutil.copy(source(name), target(name))
+
+    return {'gyms': len(gyms), 'members': member_count * scale, 'trainers': trainer_count * scale,
+            'reviews': len(reviews) * scale, 'faqs': len(faqs) * scale,
+            'occupancy_rows': len(occupancy) * min(scale, OCCUPANCY_MAX_COPIES)}
+
+
+#2. Scripted conversations - after logging in (or choosing 'new'), each flow is a list of answers given one by one.
+# The answers are functions of a random generator and the dataset sizes, so every iteration asks about a different member or gym
+
+FLOWS = {
+    'registration': lambda rng, sizes: ['1', 'Jane', 'Doe', f'jane{rng.integers(1e6)}@example.com', '5145550123', 'H3A1W9', '2', 'yes'],
+    'manage_membership': lambda rng, sizes: ['1', str(rng.choice(['pause', 'reactivate']))],
+    'profile_analytics': lambda rng, sizes: ['2'],
+    'nearest_gym': lambda rng, sizes: ['3', str(rng.choice(['H3A', 'H4W', 'H9W', 'H3Z'])), str(rng.choice(['yoga', 'cardio, weights', 'pool']))],
+    'trainer_match': lambda rng, sizes: ['4', str(rng.choice(['yoga', 'pilates', 'strength training', 'cardio']))],
+    'exercises': lambda rng, sizes: ['5', str(rng.choice(['Biceps', 'Shoulders', 'Triceps']))],
+    'occupancy': lambda rng, sizes: ['6', str(rng.integers(1, sizes['gyms'] + 1)), str(rng.choice(['today', 'tomorrow', 'monday']))],
+    'faq': lambda rng, sizes: ['7', str(rng.choice(['Can I bring a friend?', 'I lost my key', 'is there wifi', 'do you have lockers']))],
+}
+
+
+#3. Function to run one scripted flow in a fresh session and return the seconds spent in the flow's own turns
+# Logging in and the final exit are not timed. A flow that ends the session or reports an internal error raises RuntimeError
+
+def run_flow(chatbot, flow, rng, sizes):
+    session = chatbot.start_session()
+    answers = FLOWS[flow](rng, sizes)
+    if flow == 'registration':
+        chatbot.reply(session, 'new')
+    else:
+        chatbot.reply(session, 'existing')
+        chatbot.reply(session, f"gym_{rng.integers(1, sizes['members'] + 1)}")
+    chatbot.take_messages(session)
+
+    start = datetime.now()
+    for answer in answers:
+        chatbot.reply(session, answer)
+    seconds = (datetime.now() - start).total_seconds()
+
+    messages = chatbot.take_messages(session)
+    if any('internal error' in message for message in messages) or (session.finished and flow != 'registration'):
+        raise RuntimeError(f"{flow} did not complete: {messages[-1:]}")
+    chatbot.reply(session, '2')
+    return seconds
+
+
+#4. Function to benchmark every flow at one scale - run in a worker process whose working directory is the synthetic dataset
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        return probe.getsockname()[1]
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+def benchmark_scale(scale, iterations):
+    folder = tempfile.mkdtemp(prefix=f'anytime_bench_{scale}x_')
+    try:
+        sizes = build_dataset(scale, folder)
+        os.chdir(folder)
+
+        # The chatbot reads its wger and SMTP settings at import time, so they point at the stand-in servers before the import
+        wger_port, smtp_port = free_port(), free_port()
+        os.environ.update({'ANYTIME_WGER_URL': f'http://localhost:{wger_port}/api/v2',
+                           'ANYTIME_SMTP_HOST': 'localhost', 'ANYTIME_SMTP_PORT': str(smtp_port),
+                           'ANYTIME_SMTP_STARTTLS': '0', 'ANYTIME_SMTP_USER': '', 'ANYTIME_SMTP_PASSWORD': ''})
+        sys.path.insert(0, CHATBOT_DIR)
+        chatbot = importlib.import_module(CHATBOT_MODULE)
+        for server in (chatbot.run_fake_wger_server(wger_port), chatbot.run_smtp_sink(smtp_port)):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        chatbot.start_mail_worker()
+
+        # Models, tables and indexes are built once before timing, their cost is reported as setup time
+        setup = {}
+        start = datetime.now()
+        chatbot.load_occupancy_table()
+        setup['occupancy_table_s'] = (datetime.now() - start).total_seconds()
+        skipped = {}
+        try:
+            start = datetime.now()
+            chatbot.load_trainer_ratings()
+            setup['trainer_ratings_s'] = (datetime.now() - start).total_seconds()
+        except LookupError:
+            skipped['trainer_match'] = "VADER lexicon not available, install it with nltk.download('vader_lexicon')"
+
+        results = []
+        for flow in FLOWS:
+            if flow in skipped:
+                results.append({'flow': flow, 'skipped': skipped[flow]})
+                continue
+            rng = np.random.default_rng(7)
+            errors = []
+            latencies = []
+            cold = None
+            run_start = datetime.now()
+            for iteration in range(iterations + 1):
+                try:
+                    seconds = run_flow(chatbot, flow, rng, sizes)
+                except RuntimeError as error:
+                    errors.append(str(error))
+                    continue
+                if iteration == 0:
+                    cold = seconds
+                else:
+                    latencies.append(seconds)
+            elapsed = (datetime.now() - run_start).total_seconds()
+
+            tracemalloc.start()
+            try:
+                run_flow(chatbot, flow, rng, sizes)
+            except RuntimeError as error:
+                errors.append(str(error))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results.append({'flow': flow, 'iterations': len(latencies), 'errors': len(errors), 'first_error': errors[0] if errors else None,
+                            'cold_ms': cold * 1000 if cold is not None else None,
+                            'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+                            'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+                            'mean_ms': float(np.mean(latencies)) * 1000 if latencies else None,
+                            # complete sessions per second, including logging in and exiting
+                            'throughput_per_s': (len(latencies) + 1) / elapsed if elapsed else None,
+                            'peak_memory_kib': peak / 1024})
+
+        chatbot.flush_mail_queue()
+        return {'scale': scale, 'sizes': sizes, 'setup': setup, 'mail': chatbot.mail_metrics(), 'flows': results}
+    finally:
+        os.chdir(CHATBOT_DIR)
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+#5. Function to run every scale in its own worker process and collect the results with the commit they were measured on
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=CHATBOT_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(scales, iterations):
+    report = {'commit': git_commit(), 'started_at': datetime.now().isoformat(timespec='seconds'),
+              'python': sys.version.split()[0], 'iterations': iterations, 'results': []}
+    for scale in scales:
+        print(f"Benchmarking the {scale}x dataset...", file=sys.stderr)
+        worker = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', str(scale), '--iterations', str(iterations)],
+                                capture_output=True, text=True)
+        if worker.returncode != 0:
+            report['results'].append({'scale': scale, 'error': worker.stderr.strip().splitlines()[-1:]})
+            continue
+        report['results'].append(json.loads(worker.stdout.strip().splitlines()[-1]))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the AnytimeAssistant chatbot flows')
+    parser.add_argument('--scales', default=','.join(map(str, DEFAULT_SCALES)), help='comma separated dataset scales, e.g. 1,10,100')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS, help='timed runs of every flow per scale')
+    parser.add_argument('--output', help='file to write the JSON report to, printed when omitted')
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(benchmark_scale(args.worker, args.iterations)))
+    else:
+        report = json.dumps(run_benchmarks([int(scale) for scale in args.scales.split(',')], args.iterations), indent=2)
+        if args.output:
+            with open(args.output, 'w') as file:
+                file.write(report)
+        else:
+            print(report)
@@ -7,83 +7,465 @@ ANYTIME ASSISTANT - CHATBOT FOR ANYTIME FITNESS
 #For handling regex matching for user input validation
 import re  
 
-#For managing dataframes - collecting, manipulating and storing data
-import pandas as pd  
+#For lazily importing the heavy libraries below - the chatbot greets the user before any of them are loaded
+import importlib
+import importlib.util
+import subprocess
 
-#For calculating distance between two coordinates using haversine formula
-import math  
+#For answering faqs from the FAQ knowledge base with a BM25 ranked inverted index
+import csv
+import math
+import heapq
+from collections import Counter
 
-#For plotting customer's profile analytics dashboard
-import matplotlib.pyplot as plt
+#For fuzzy matching free text amenities against the amenity vocabulary
+import difflib
+from functools import lru_cache, partial
 
 #For triggering confirmation email to user after enrollment
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-
-#For content filtering using cosine similarity and sentiment analysis
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import CountVectorizer
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
+import socketserver
+import uuid
 
 #For accessing datetime functions
 import datetime
 from datetime import date, time, datetime, timedelta
 import calendar
 
-#For predicting gym occupancy using RandomForest Regression
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestRegressor
-
 #For triggering an api request
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import json
+from urllib.parse import urlparse, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+#For persisting trained models and detecting changes in the source data
+import os
+import io
+import threading
+import contextvars
+import asyncio
+import sqlite3
+from contextlib import contextmanager
+import sys
+import pickle
+import hashlib
+import tempfile
 
 #To avoid warning messages from being printed in the output
 import warnings
 warnings.filterwarnings("ignore")
 
+#Heavy libraries - each is imported the first time a flow uses it, see LazyModule. Names imported from them
+#(BallTree, TfidfVectorizer, SentimentIntensityAnalyzer, RandomForestRegressor, ...) are imported inside the functions using them
+#   pandas           - managing dataframes - collecting, manipulating and storing data
+#   numpy            - calculating distance between two coordinates using haversine formula
+#   matplotlib       - plotting customer's profile analytics dashboard
+#   sklearn          - nearest gym search, trainer matching and predicting gym occupancy using RandomForest Regression
+#                      (or histogram gradient boosting, see OCCUPANCY_MODEL_BACKEND)
+#   nltk             - sentiment analysis of trainer reviews
+#   requests         - triggering an api request
+#   smtplib, email   - sending the confirmation email to user after enrollment
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attribute)
+
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+plt = LazyModule('matplotlib.pyplot')
+requests = LazyModule('requests')
+smtplib = LazyModule('smtplib')
+
+#Data files shared by the chatbot flows
+USER_DATA_FILE = 'user_data.xlsx'
+GYM_DATA_FILE = 'gym_data.xlsx'
+ZIPCODE_FILE = 'zipcode_master.xlsx'
+GYM_USAGE_FILE = 'gym_usage_2.csv'
+TRAINERS_FILE = 'gym_trainers_dataset.csv'
+REVIEWS_FILE = 'gym_trainer_reviews.csv'
+FAQ_FILE = 'gym_faq.csv'
+
+#Optional file of full postal codes (columns postalCode, lat, long), used before falling back to the 3 character prefixes in zipcode_master.xlsx
+POSTAL_CODE_FILE = os.environ.get('ANYTIME_POSTAL_CODE_FILE', 'postal_codes.csv')
+
+#Cache of VADER scores per review, keyed by a hash of the review text so only new reviews are scored
+REVIEW_SCORE_CACHE_FILE = 'review_scores.csv'
+
+#wger exercise API - responses are cached for WGER_CACHE_TTL and the muscle, exercise and image endpoints can be mirrored
+#locally with the sync-wger command, recommendations are then served from WGER_MIRROR_FILE without network access
+WGER_BASE_URL = os.environ.get('ANYTIME_WGER_URL', 'https://wger.de/api/v2')
+WGER_MIRROR_FILE = 'wger_mirror.json'
+WGER_CACHE_TTL = timedelta(hours=24)
+WGER_TIMEOUT = (3.05, 10)  # (connect, read) seconds per request
+WGER_MAX_RETRIES = 3
+WGER_POOL_SIZE = 10
+
+#Outbound mail - messages are spooled to MAIL_SPOOL_DIR and sent in batches over one SMTP connection by a background worker
+#For local testing run the mail-sink command and set ANYTIME_SMTP_HOST=localhost ANYTIME_SMTP_PORT=8025 ANYTIME_SMTP_STARTTLS=0
+#The credentials are only used when the server offers AUTH, so the sink works without clearing them
+SMTP_HOST = os.environ.get('ANYTIME_SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('ANYTIME_SMTP_PORT', '587'))
+SMTP_STARTTLS = os.environ.get('ANYTIME_SMTP_STARTTLS', '1') == '1'
+SMTP_USER = os.environ.get('ANYTIME_SMTP_USER', 'jacksonreo31@gmail.com')
+SMTP_PASSWORD = os.environ.get('ANYTIME_SMTP_PASSWORD', 'password')
+MAIL_FROM = "Anytime Fitness <jacksonreo31@gmail.com>"
+MAIL_SPOOL_DIR = 'mail_spool'
+MAIL_BATCH_SIZE = 50
+MAIL_MAX_ATTEMPTS = 5
+MAIL_RETRY_BASE_SECONDS = 30
+MAIL_POLL_SECONDS = 5
+
+#FAQ retrieval - answers scoring below FAQ_MIN_SCORE, or below FAQ_MIN_SHARE of the best score the question's terms could reach,
+#are not shown. FAQ_TOP_K includes the best answer and the related questions
+FAQ_MIN_SCORE = 1.0
+FAQ_MIN_SHARE = 0.25
+FAQ_TOP_K = 3
+FAQ_BM25_K1 = 1.5
+FAQ_BM25_B = 0.75
+FAQ_STOP_WORDS = {'a', 'an', 'and', 'are', 'at', 'be', 'can', 'do', 'does', 'for', 'get', 'have', 'how', 'i', 'if',
+                  'in', 'is', 'it', 'me', 'my', 'of', 'on', 'or', 'the', 'there', 'to', 'what', 'when', 'where', 'while',
+                  'with', 'you', 'your', 'we', 'our', 'am', 'will', 'would', 'should', 'could', 'this', 'that', 'please'}
+#Words found in questions on every topic, they say the question is about the gym but not what about it
+FAQ_DOMAIN_WORDS = {'gym', 'anytime', 'fitness', 'club', 'location', 'member', 'membership'}
+
+#Conversation server - idle sessions are dropped after SESSION_IDLE_TIMEOUT, charts of headless sessions are saved to CHART_DIR
+SESSION_IDLE_TIMEOUT = timedelta(minutes=30)
+CHART_DIR = 'charts'
+#Largest request body the server reads, a chat message is a few hundred bytes
+MAX_REQUEST_BODY = 1 << 16
+
+#Profile analytics - macronutrient ratios (% of calories from carbs, protein and fat) based on activity level
+MACRO_RATIOS = {
+    'low': {'carbs': 45, 'protein': 25, 'fat': 30},
+    'moderate': {'carbs': 50, 'protein': 30, 'fat': 20},
+    'active': {'carbs': 55, 'protein': 35, 'fat': 10}
+}
+NUTRITION_REPORT_FILE = 'nutrition_report.csv'
+
+#Maximum number of members a trainer can be assigned
+TRAINER_CAPACITY = int(os.environ.get('ANYTIME_TRAINER_CAPACITY', '10'))
+#Number of best matching trainers fetched per request, doubled while all of them are at capacity
+TRAINER_SEARCH_K = 5
+
+#User repository - 'sqlite' keeps members in USER_DB_FILE (seeded from user_data.xlsx), 'excel' reads and writes user_data.xlsx directly
+USER_STORE = os.environ.get('ANYTIME_USER_STORE', 'sqlite')
+USER_DB_FILE = 'user_data.db'
+USER_COLUMNS = ['customerId', 'first_name', 'last_name', 'email', 'phone', 'zipcode', 'membershipPlan', 'status',
+                'cancelReason', 'gender', 'age', 'height', 'weight', 'activity_level', 'trainer']
+USER_NUMERIC_COLUMNS = ['age', 'height', 'weight']
+
+#Data files and model registry used by the occupancy prediction
+OCCUPANCY_DATA_FILE = 'gym_occupancy.csv'
+OCCUPANCY_MODEL_FILE = 'occupancy_model.pkl'
+OCCUPANCY_FEATURES = ['gymId', 'month', 'day_of_week', 'hour']
+OCCUPANCY_TABLE_FILE = 'occupancy_best_hours.pkl'
+OCCUPANCY_TABLE_MAX_AGE = timedelta(hours=24)
+
+#Occupancy model - one model for the whole network ('global'), one per gym ('gym') or one per group of gyms with a similar weekly
+#profile ('cluster'). Partitioned models are trained in parallel by OCCUPANCY_TRAIN_WORKERS processes, all cores when unset
+#Each model is one of OCCUPANCY_BACKENDS:
+#   forest       - RandomForestRegressor with 100 full depth trees, the most accurate and the largest
+#   forest-lite  - RandomForestRegressor with 30 trees of depth at most 12
+#   hgb          - HistGradientBoostingRegressor, small and fast to predict
+#   mean         - historical mean occupancy per gym/day of week/hour, a lookup table without any training
+OCCUPANCY_BACKENDS = ['forest', 'forest-lite', 'hgb', 'mean']
+OCCUPANCY_MODEL_BACKEND = os.environ.get('ANYTIME_OCCUPANCY_MODEL_BACKEND', 'forest')
+OCCUPANCY_COMPARISON_FILE = 'occupancy_model_comparison.csv'
+OCCUPANCY_MODEL_SCOPE = os.environ.get('ANYTIME_OCCUPANCY_MODEL_SCOPE', 'global')
+OCCUPANCY_CLUSTERS = int(os.environ.get('ANYTIME_OCCUPANCY_CLUSTERS', '8'))
+OCCUPANCY_TRAIN_WORKERS = int(os.environ.get('ANYTIME_OCCUPANCY_TRAIN_WORKERS', '0')) or None
+OCCUPANCY_TRAINING_REPORT_FILE = 'occupancy_training_report.csv'
+
+#Occupancy history ingestion - the csv is read OCCUPANCY_CHUNK_ROWS rows at a time with compact dtypes and reduced to statistics per
+#gym/month/day/hour, which are cached as Feather (memory mapped on load) when pyarrow is installed and as a pickle otherwise
+OCCUPANCY_CHUNK_ROWS = int(os.environ.get('ANYTIME_OCCUPANCY_CHUNK_ROWS', '1000000'))
+OCCUPANCY_DTYPES = {'number_people': 'uint16', 'day_of_week': 'uint8', 'month': 'uint8', 'hour': 'uint8', 'gymId': 'uint16'}
+OCCUPANCY_STATS_FILE = 'occupancy_stats'
+OCCUPANCY_STATS_META_FILE = 'occupancy_stats.json'
+#Readings appended to the csv are folded into the cached statistics, the cache remembers the byte offset it has read up to and a
+#signature of the last OCCUPANCY_TAIL_BYTES before it to recognise an append-only file
+OCCUPANCY_TAIL_BYTES = 1 << 16
+
+
+#0.1 Data store - Function to load a dataset once and keep it in memory, it is only re-read when the file's mtime or size changes
+# The returned frame is shared by all flows, so callers that modify it must work on a copy
+
+_data_cache = {}
+_data_lock = threading.Lock()
+
+def load_data(path):
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _data_lock:
+        cached = _data_cache.get(path)
+        if cached is None or cached['version'] != version:
+            if path.endswith('.xlsx'):
+                frame = pd.read_excel(path)
+            else:
+                frame = pd.read_csv(path)
+            cached = {'version': version, 'frame': frame, 'indexes': {}}
+            _data_cache[path] = cached
+        return cached['frame']
+
+
+#0.2 Data store - Function to return a dataset indexed by a key column, e.g. users by customerId or gyms by gymId
+
+def load_indexed(path, key):
+    load_data(path)
+    with _data_lock:
+        # The index is built from the frame of the entry it is stored in, even if another thread reloaded the file meanwhile
+        cached = _data_cache[path]
+        if key not in cached['indexes']:
+            cached['indexes'][key] = cached['frame'].set_index(key, drop=False)
+        return cached['indexes'][key]
+
+
+#0.3 Data store - Shortcut for the gyms indexed by gymId
+
+def load_gyms():
+    return load_indexed(GYM_DATA_FILE, 'gymId')
+
+
+#0.4 Data store - Function to write a dataset back to disk and refresh the in-memory copy so the next read does not re-parse the file
+
+def save_data(path, frame):
+    if path.endswith('.xlsx'):
+        frame.to_excel(path, index=False)
+    else:
+        frame.to_csv(path, index=False)
+    stat = os.stat(path)
+    with _data_lock:
+        _data_cache[path] = {'version': (stat.st_mtime_ns, stat.st_size), 'frame': frame.reset_index(drop=True), 'indexes': {}}
+
+
+#0.4.1 Data store - Context manager to write a generated file atomically. It yields a temporary path unique to this writer in the
+# same directory, which replaces path once the block succeeds, so concurrent writers and readers never see a half written file
+
+@contextmanager
+def atomic_file(path):
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp_file
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+#0.5 User repository - Excel backend, keeps the original behaviour of rewriting user_data.xlsx on every change
+
+class ExcelUserRepository:
+    def __init__(self, path=USER_DATA_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get(self, customer_id):
+        users = load_indexed(self.path, 'customerId')
+        if customer_id not in users.index:
+            return None
+        user = users.loc[customer_id]
+        return user.where(user.notna(), None).to_dict()
+
+    def exists(self, customer_id):
+        return customer_id in load_indexed(self.path, 'customerId').index
+
+    def create(self, fields):
+        with self._lock:
+            df = load_data(self.path)
+            numbers = pd.to_numeric(df['customerId'].str.extract(r'^gym_(\d+)$')[0], errors='coerce')
+            customer_id = 'gym_' + str(int(numbers.max()) + 1 if numbers.notna().any() else 1)
+            new_row = dict(fields, customerId=customer_id)
+            save_data(self.path, pd.concat([df, pd.DataFrame([new_row])], ignore_index=True))
+        return customer_id
+
+    def update(self, customer_id, fields):
+        self.update_many({customer_id: fields})
+
+    def update_many(self, updates):
+        with self._lock:
+            df = load_data(self.path).copy()
+            for customer_id, fields in updates.items():
+                condition = df['customerId'] == customer_id
+                for column, value in fields.items():
+                    df.loc[condition, column] = value
+            save_data(self.path, df)
+
+    def all(self):
+        return load_data(self.path).copy()
+
+    def import_excel(self, path):
+        save_data(self.path, pd.read_excel(path))
+
+    def export_excel(self, path):
+        self.all().to_excel(path, index=False)
+
+
+#0.6 User repository - SQLite backend, single row inserts and updates run inside transactions and every change is appended to a user_changes log
+
+class SqliteUserRepository:
+    def __init__(self, path=USER_DB_FILE, seed_file=USER_DATA_FILE):
+        self.path = path
+        self._local = threading.local()
+        columns = ', '.join(f"{column} {'REAL' if column in USER_NUMERIC_COLUMNS else 'TEXT'}" for column in USER_COLUMNS[1:])
+        with self.transaction() as conn:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS users (seq INTEGER PRIMARY KEY AUTOINCREMENT, customerId TEXT UNIQUE, {columns})")
+            conn.execute("CREATE TABLE IF NOT EXISTS user_changes (changeId INTEGER PRIMARY KEY AUTOINCREMENT, customerId TEXT, field TEXT, "
+                         "old_value TEXT, new_value TEXT, changed_at TEXT DEFAULT CURRENT_TIMESTAMP)")
+            is_empty = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0
+        if is_empty and seed_file and os.path.exists(seed_file):
+            self.import_excel(seed_file)
+
+    # One connection per thread, sqlite connections must not be shared between threads
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    # BEGIN IMMEDIATE takes the write lock up front so two sessions cannot interleave a read-modify-write
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def get(self, customer_id):
+        row = self.connection().execute("SELECT * FROM users WHERE customerId = ?", (customer_id,)).fetchone()
+        if row is None:
+            return None
+        user = dict(row)
+        del user['seq']
+        return user
+
+    def exists(self, customer_id):
+        return self.connection().execute("SELECT 1 FROM users WHERE customerId = ?", (customer_id,)).fetchone() is not None
+
+    # The customer id is derived from the AUTOINCREMENT key inside the insert transaction, so concurrent enrollments never share an id
+    def create(self, fields):
+        check_user_columns(fields)
+        columns = [column for column in fields if column != 'customerId']
+        with self.transaction() as conn:
+            cursor = conn.execute(f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                                  [fields[column] for column in columns])
+            customer_id = 'gym_' + str(cursor.lastrowid)
+            conn.execute("UPDATE users SET customerId = ? WHERE seq = ?", (customer_id, cursor.lastrowid))
+            conn.execute("INSERT INTO user_changes (customerId, field, new_value) VALUES (?, 'created', NULL)", (customer_id,))
+        return customer_id
+
+    def update(self, customer_id, fields):
+        self.update_many({customer_id: fields})
+
+    def update_many(self, updates):
+        with self.transaction() as conn:
+            for customer_id, fields in updates.items():
+                check_user_columns(fields)
+                old = conn.execute("SELECT * FROM users WHERE customerId = ?", (customer_id,)).fetchone()
+                if old is None:
+                    raise KeyError(customer_id)
+                conn.execute(f"UPDATE users SET {', '.join(column + ' = ?' for column in fields)} WHERE customerId = ?",
+                             list(fields.values()) + [customer_id])
+                conn.executemany("INSERT INTO user_changes (customerId, field, old_value, new_value) VALUES (?, ?, ?, ?)",
+                                 [(customer_id, column, old[column], value) for column, value in fields.items()])
+
+    def all(self):
+        return pd.read_sql_query(f"SELECT {', '.join(USER_COLUMNS)} FROM users ORDER BY seq", self.connection())
+
+    # Rows keep their gym_<n> id, and <n> is used as the sequence number so new ids continue after the imported ones
+    def import_excel(self, path):
+        df = pd.read_excel(path)
+        df = df[[column for column in USER_COLUMNS if column in df.columns]].astype(object)
+        df = df.where(df.notna(), None)
+        columns = ['seq'] + list(df.columns)
+        rows = []
+        for row in df.itertuples(index=False):
+            match = re.match(r"^gym_(\d+)$", str(row.customerId))
+            rows.append([int(match.group(1)) if match else None] + list(row))
+        with self.transaction() as conn:
+            conn.executemany(f"INSERT OR REPLACE INTO users ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})", rows)
+
+    def export_excel(self, path):
+        self.all().to_excel(path, index=False)
+
+
+#0.7 Function to reject unknown user fields, column names are interpolated into SQL so they must come from USER_COLUMNS
+
+def check_user_columns(fields):
+    unknown = set(fields) - set(USER_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown user fields: {', '.join(sorted(unknown))}")
+
+
+#0.8 Function to return the shared user repository for the configured USER_STORE, created on first use
+
+_user_repository = None
+
+def get_user_repository():
+    global _user_repository
+    if _user_repository is None:
+        if USER_STORE == 'excel':
+            _user_repository = ExcelUserRepository()
+        else:
+            _user_repository = SqliteUserRepository()
+    return _user_repository
+
 
 #1. Function to display the options for a new user:
+# Menus and the return-to-menu prompts do not call each other, they return the next screen to show (or None to end the
+# conversation) and run_screens() moves from screen to screen in a loop, so going back to a menu never deepens the stack
 
 def new_user_options():
-    print("Welcome, new user! How can we assist you today?")
-    print("1. Enroll in Anytime Fitness")
-    print("2. General Information")
-    choice = input("Please choose an option (1/2): ")
+    say("Welcome, new user! How can we assist you today?")
+    say("1. Enroll in Anytime Fitness")
+    say("2. General Information")
+    choice = (yield "Please choose an option (1/2): ")
     
     if choice == "1":
-        new_user_registration()
+        yield from new_user_registration()
     elif choice == "2":
-        general_info()
+        return general_info
     else:
-        print("Sorry, we couldn't understand your choice.")
+        say("Sorry, we couldn't understand your choice.")
 
 
 #2. Function to handle the registration flow for a new user:
 
 def get_user_info():
-    print("Take the time to discover Anytime Fitness. Access is FREE, and we'd love to show you around our gym!")
-    first_name = input("What's your first name? ")
-    last_name = input("What's your last name? ")
+    say("Take the time to discover Anytime Fitness. Access is FREE, and we'd love to show you around our gym!")
+    first_name = (yield "What's your first name? ")
+    last_name = (yield "What's your last name? ")
 
     while True:
-        email = input("What's your email address? ")
+        email = (yield "What's your email address? ")
         if not validate_email(email):
-            print("Invalid email format. Please enter a valid email address.")
+            say("Invalid email format. Please enter a valid email address.")
         else:
             break
 
     while True:
-        phone_number = input("What's your phone number? ")
+        phone_number = (yield "What's your phone number? ")
         if not validate_phone_number(phone_number):
-            print("Invalid phone number format. Please enter a valid phone number.")
+            say("Invalid phone number format. Please enter a valid phone number.")
         else:
             break
 
     while True:
-        zipcode = input("What's your zipcode? ")
+        zipcode = (yield "What's your zipcode? ")
         if not validate_zipcode(zipcode):
-            print("Invalid zipcode format. Please enter a valid zipcode.")
+            say("Invalid zipcode format. Please enter a valid zipcode.")
         else:
             break
     
@@ -127,13 +509,14 @@ Price: $50/month
 Offerings: All-inclusive access, including premium gym features and spa services.
 Price: $80/month'''
 
-    print(text)
-    membership_type = input("\nPlease enter your choice (Enter 1/2/3): ")
-    if membership_type not in ["1","2","3"]:
-        print("Please select a valid membership plan (1/2/3)")
-        return display_terms_and_conditions()
-    else:
-        text = '''\nHere are our terms and conditions:
+    while True:
+        say(text)
+        membership_type = (yield "\nPlease enter your choice (Enter 1/2/3): ")
+        if membership_type in ["1","2","3"]:
+            break
+        say("Please select a valid membership plan (1/2/3)")
+
+    text = '''\nHere are our terms and conditions:
 1. Must be 18 years of age or older. Valid ID required.
 2. Valid at participating locations only.
 3. Terms and conditions may vary.
@@ -142,7 +525,7 @@ Price: $80/month'''
 6. I can withdraw my consent at any time.
 7. Message and data rates apply.
 8. Full terms and conditions can be found at: www.anytimefitness.com or your local Anytime Fitness club.'''
-    print(text)
+    say(text)
         
     return membership_type
   
@@ -150,30 +533,26 @@ Price: $80/month'''
 #2.5 Function to confirm if all the information is correct and prompts user to accept Terms and Conditions
 
 def new_user_registration():
-    print("\n** New User Registration **")
-    first_name, last_name, email, phone_number, zipcode = get_user_info()
-    membership_type = display_terms_and_conditions()
-    agreement = input("\nDo you agree to the terms and conditions? (type 'yes' or 'no') ")
+    say("\n** New User Registration **")
+    first_name, last_name, email, phone_number, zipcode = yield from get_user_info()
+    membership_type = yield from display_terms_and_conditions()
+    agreement = (yield "\nDo you agree to the terms and conditions? (type 'yes' or 'no') ")
     membership_type = membership_type.replace("1","Standard").replace("2","Premium").replace("3","Platinum")        
     if agreement.lower() == 'yes':
         submit_info(first_name, last_name, email, phone_number, zipcode, membership_type)
-        print("Registration successful!")
+        say("Registration successful!")
     else:
-        print("We're sorry, you need to agree to the terms and conditions to continue.")
+        say("We're sorry, you need to agree to the terms and conditions to continue.")
 
         
 #2.6 Function for final submission of user information for registration
 
 def submit_info(first_name, last_name, email, phone_number, zipcode,membership_type):
-    print("\nThank you for providing your information, {}!".format(first_name))
-    print("You're now eligible for a 7-day free trial pass at Anytime Fitness.")
-    print("We'll send you an email with more information on how to activate your trial pass.")
-    print("Thank you for choosing AnytimeAssistant and Anytime Fitness!")
-    df = pd.read_excel('user_data.xlsx')
-    customer_id = 'gym_' + str(len(df) + 1)
-    
-    new_row = {
-    'customerId': customer_id,
+    say("\nThank you for providing your information, {}!".format(first_name))
+    say("You're now eligible for a 7-day free trial pass at Anytime Fitness.")
+    say("We'll send you an email with more information on how to activate your trial pass.")
+    say("Thank you for choosing AnytimeAssistant and Anytime Fitness!")
+    new_user = {
     'first_name': first_name,
     'last_name': last_name,
     'email': email,
@@ -185,15 +564,14 @@ def submit_info(first_name, last_name, email, phone_number, zipcode,membership_t
     'trainer': 'NA'
 }
 
-    df = df.append(new_row, ignore_index=True)
-    df.to_excel('user_data.xlsx',index=False)
+    customer_id = get_user_repository().create(new_user)
     try:
         email_sender(customer_id, first_name, email, membership_type)
-    except:
-        pass
+    except OSError as error:
+        say(f"We could not queue your confirmation email ({error}), please contact your home club for your enrollment details.")
 
 
-#2.7 Function to trigger an email to the user after registration
+#2.7 Function to queue the confirmation email to the user after registration, it is delivered by the mail worker
 
 def email_sender(customer_id, first_name, email, membership_type):
     
@@ -213,86 +591,288 @@ Once again, welcome to Anytime Fitness! We can't wait to see you at the gym and
 Best regards,
 Anytime Fitness Team'''
 
-    fromName = "Anytime Fitness"
-    fromAddr = "jacksonreo31@gmail.com"
-    toaddr = email
-    rcpt = [toaddr]
-    msg = MIMEMultipart('alternative')
-    msg['From'] = "{} <{}>".format(fromName,fromAddr)
-    msg['To'] = toaddr
-    msg['Subject'] = "Gym Membership Enrollment Confirmation"
-    body = text
-    msg.attach(MIMEText(body, 'plain'))
-    s = smtplib.SMTP('smtp.gmail.com', 587)
-    s.starttls()
-    s.login(fromAddr, "password")
-    text = msg.as_string()
-    s.sendmail(fromAddr, rcpt, text)
-    s.quit() 
+    enqueue_email(email, "Gym Membership Enrollment Confirmation", text)
+
+
+#2.8 Mail queue - Function to add an email to the persistent spool and wake up the mail worker
+# Each message is its own json file, written atomically, so queued mail survives restarts
+
+_mail_lock = threading.Lock()
+_mail_send_lock = threading.Lock()
+_mail_wakeup = threading.Event()
+_mail_worker = None
+_mail_metrics = {'enqueued': 0, 'sent': 0, 'retried': 0, 'failed': 0, 'batches': 0, 'connections': 0, 'send_seconds': 0.0, 'last_error': None}
+
+def enqueue_email(to, subject, body):
+    os.makedirs(MAIL_SPOOL_DIR, exist_ok=True)
+    message = {
+        'id': f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}",
+        'to': to,
+        'subject': subject,
+        'body': body,
+        'attempts': 0,
+        'next_attempt_at': datetime.now().isoformat(),
+        'last_error': None
+    }
+    write_spooled_email(message)
+    with _mail_lock:
+        _mail_metrics['enqueued'] += 1
+    start_mail_worker()
+    _mail_wakeup.set()
+    return message['id']
+
+
+#2.9 Mail queue - Functions to read and write spooled messages
+
+def spooled_email_path(message_id, folder=MAIL_SPOOL_DIR):
+    return os.path.join(folder, message_id + '.json')
+
+def write_spooled_email(message, folder=MAIL_SPOOL_DIR):
+    path = spooled_email_path(message['id'], folder)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(message, f)
+    os.replace(path + '.tmp', path)
+
+def pending_emails(due_only=True):
+    if not os.path.isdir(MAIL_SPOOL_DIR):
+        return []
+    messages = []
+    now = datetime.now().isoformat()
+    for name in sorted(os.listdir(MAIL_SPOOL_DIR)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(MAIL_SPOOL_DIR, name)) as f:
+                message = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not due_only or message['next_attempt_at'] <= now:
+            messages.append(message)
+    return messages
+
+
+#2.10 Mail queue - Function to reschedule a message that could not be sent, with exponential backoff
+# After MAIL_MAX_ATTEMPTS the message is moved to the failed folder of the spool
+
+def schedule_email_retry(message, error):
+    message['attempts'] += 1
+    message['last_error'] = str(error)
+    with _mail_lock:
+        _mail_metrics['last_error'] = str(error)
+        if message['attempts'] >= MAIL_MAX_ATTEMPTS:
+            _mail_metrics['failed'] += 1
+        else:
+            _mail_metrics['retried'] += 1
+    if message['attempts'] >= MAIL_MAX_ATTEMPTS:
+        failed_dir = os.path.join(MAIL_SPOOL_DIR, 'failed')
+        os.makedirs(failed_dir, exist_ok=True)
+        write_spooled_email(message, failed_dir)
+        os.remove(spooled_email_path(message['id']))
+    else:
+        delay = MAIL_RETRY_BASE_SECONDS * 2 ** (message['attempts'] - 1)
+        message['next_attempt_at'] = (datetime.now() + timedelta(seconds=delay)).isoformat()
+        write_spooled_email(message)
+
+
+#2.11 Mail queue - Function to open an SMTP connection, STARTTLS and login are skipped when disabled or without credentials (e.g. a local sink)
+
+def open_smtp_connection():
+    connection = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+    if SMTP_STARTTLS:
+        connection.starttls()
+    connection.ehlo_or_helo_if_needed()
+    if SMTP_USER and SMTP_PASSWORD and connection.has_extn('auth'):
+        connection.login(SMTP_USER, SMTP_PASSWORD)
+    return connection
+
+
+#2.12 Mail queue - Function to send up to MAIL_BATCH_SIZE due messages over a single SMTP connection, returns the number sent
+
+def send_email_batch():
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    with _mail_send_lock:
+        messages = pending_emails()[:MAIL_BATCH_SIZE]
+        if not messages:
+            return 0
+        start = datetime.now()
+        try:
+            connection = open_smtp_connection()
+        except (smtplib.SMTPException, OSError) as error:
+            for message in messages:
+                schedule_email_retry(message, error)
+            return 0
+        
+        sent = 0
+        try:
+            for message in messages:
+                msg = MIMEMultipart('alternative')
+                msg['From'] = MAIL_FROM
+                msg['To'] = message['to']
+                msg['Subject'] = message['subject']
+                msg.attach(MIMEText(message['body'], 'plain'))
+                try:
+                    connection.sendmail(SMTP_USER or MAIL_FROM, [message['to']], msg.as_string())
+                except (smtplib.SMTPException, OSError) as error:
+                    schedule_email_retry(message, error)
+                    if isinstance(error, (smtplib.SMTPServerDisconnected, OSError)):
+                        break
+                    continue
+                os.remove(spooled_email_path(message['id']))
+                sent += 1
+        finally:
+            try:
+                connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+        
+        with _mail_lock:
+            _mail_metrics['sent'] += sent
+            _mail_metrics['batches'] += 1
+            _mail_metrics['connections'] += 1
+            _mail_metrics['send_seconds'] += (datetime.now() - start).total_seconds()
+        return sent
+
+
+#2.13 Mail queue - Background worker that keeps sending batches, and sleeps until new mail arrives or MAIL_POLL_SECONDS pass
+
+def mail_worker_loop():
+    while True:
+        try:
+            sent = send_email_batch()
+        except Exception as error:
+            with _mail_lock:
+                _mail_metrics['last_error'] = str(error)
+            sent = 0
+        if sent == 0:
+            _mail_wakeup.wait(MAIL_POLL_SECONDS)
+            _mail_wakeup.clear()
+
+def start_mail_worker():
+    global _mail_worker
+    with _mail_lock:
+        if _mail_worker is None or not _mail_worker.is_alive():
+            _mail_worker = threading.Thread(target=mail_worker_loop, name='mail-worker', daemon=True)
+            _mail_worker.start()
+
+
+#2.14 Mail queue - Function to send whatever is due before the process exits, waiting at most timeout seconds
+
+def flush_mail_queue(timeout=10):
+    deadline = datetime.now() + timedelta(seconds=timeout)
+    while pending_emails() and datetime.now() < deadline:
+        if send_email_batch() == 0:
+            break
+
+
+#2.15 Mail queue - Function to return the delivery metrics, including the number of messages still waiting in the spool
+
+def mail_metrics():
+    with _mail_lock:
+        metrics = dict(_mail_metrics)
+    metrics['pending'] = len(pending_emails(due_only=False))
+    return metrics
+
+
+#2.16 Mail queue - Local SMTP sink that accepts every message and prints its recipient and subject, for testing without a real mail server
+
+def run_smtp_sink(port=8025):
+    class SmtpSinkHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.wfile.write(b"220 anytime-sink ESMTP\r\n")
+            recipients = []
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                command = line.decode('utf-8', 'replace').strip()
+                verb = command[:4].upper()
+                if verb in ('HELO', 'EHLO'):
+                    self.wfile.write(b"250 anytime-sink\r\n")
+                elif verb == 'RCPT':
+                    recipients.append(command[8:].strip(' <>'))
+                    self.wfile.write(b"250 OK\r\n")
+                elif verb == 'DATA':
+                    self.wfile.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    data = []
+                    for line in iter(self.rfile.readline, b''):
+                        if line in (b".\r\n", b".\n"):
+                            break
+                        data.append(line.decode('utf-8', 'replace'))
+                    subject = next((line[9:].strip() for line in data if line.startswith('Subject: ')), '')
+                    print(f"[mail-sink] to {', '.join(recipients)}: {subject}")
+                    recipients = []
+                    self.wfile.write(b"250 OK: queued\r\n")
+                elif verb == 'QUIT':
+                    self.wfile.write(b"221 Bye\r\n")
+                    return
+                else:
+                    # MAIL, RSET, NOOP and anything else are accepted
+                    self.wfile.write(b"250 OK\r\n")
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    return socketserver.ThreadingTCPServer(('localhost', port), SmtpSinkHandler)
 
 
 #3. Function to display general information options for a new user
 
 def general_info():
-    print("\n** Here are some options: **")
-    print("1. Membership plans")
-    print("2. Promotions & Offers")
-    print("3. Find your nearest gym")
-    print("4. FAQs")
-    choice = input("Please choose an option (1/2/3/4): ")
+    say("\n** Here are some options: **")
+    say("1. Membership plans")
+    say("2. Promotions & Offers")
+    say("3. Find your nearest gym")
+    say("4. FAQs")
+    choice = (yield "Please choose an option (1/2/3/4): ")
     
     if choice == "1":
-        print("Here's information about our membership plans.")
-        display_membership_plans()
-        repeat_trigger_new_user_flow()
+        say("Here's information about our membership plans.")
+        yield from display_membership_plans()
     elif choice == "2":
-        print("Here's information promotions & Offers.")
-        print(f'''1. Student Offers - If you are a student, please let us know at the time of enrollment. We have a special offer for you!
+        say("Here's information promotions & Offers.")
+        say(f'''1. Student Offers - If you are a student, please let us know at the time of enrollment. We have a special offer for you!
 2. 30 Days Free Membership - If you sign up for a 12-month plan, you can get the first month of your membership free of cost.
 3. 7 Day Pass/Try Us Free - If you are a new customer with a valid address in your home gym city, you are eligible to have a free 7-day trial at no cost.
 4. Free Fitness Consultation - Not sure about your fitness plan? Head over to any of our centers for a free fitness consultation with our expert to plan your fitness routine.''')
-        repeat_trigger_new_user_flow()
     elif choice == "3":
-        input_for_nearest_gym()
-        repeat_trigger_new_user_flow()
+        yield from input_for_nearest_gym()
     elif choice == "4":
-        query1 = input("\nEnter your query: ")
+        query1 = (yield "\nEnter your query: ")
         gym_faq(query1)
-        repeat_trigger_new_user_flow()
     else:
-        print("Sorry, we couldn't understand your choice.")
-        repeat_trigger_new_user_flow()
+        say("Sorry, we couldn't understand your choice.")
+    return repeat_trigger_new_user_flow
 
 
 #3.1 Function to display all the available membership plans to the user
 
 def display_membership_plans():
-    print("\n** Membership Plans **")
-    print("1. Standard Membership: Access to gym facilities.")
-    print("2. Premium Membership: Access to gym facilities, group classes, and personal training sessions.")
-    print("3. Platinum Membership: All-inclusive access, including premium features and spa services.")
-    choice = input("Please choose a membership plan (1/2/3): ")
+    say("\n** Membership Plans **")
+    say("1. Standard Membership: Access to gym facilities.")
+    say("2. Premium Membership: Access to gym facilities, group classes, and personal training sessions.")
+    say("3. Platinum Membership: All-inclusive access, including premium features and spa services.")
+    choice = (yield "Please choose a membership plan (1/2/3): ")
 
     if choice == "1":
-        print("Standard Membership:")
-        print("Access to gym facilities, including cardio and strength training areas.")
-        print("Price: $30/month")
+        say("Standard Membership:")
+        say("Access to gym facilities, including cardio and strength training areas.")
+        say("Price: $30/month")
     elif choice == "2":
-        print("Premium Membership:")
-        print("Access to gym facilities, group fitness classes, and personalized training sessions.")
-        print("Price: $50/month")
+        say("Premium Membership:")
+        say("Access to gym facilities, group fitness classes, and personalized training sessions.")
+        say("Price: $50/month")
     elif choice == "3":
-        print("Platinum Membership:")
-        print("All-inclusive access, including premium gym features and spa services.")
-        print("Price: $80/month")
+        say("Platinum Membership:")
+        say("All-inclusive access, including premium gym features and spa services.")
+        say("Price: $80/month")
     else:
-        print("Sorry, we couldn't understand your choice.")
+        say("Sorry, we couldn't understand your choice.")
 
 
 #4. Function to show all the available options for an existing user
     
 def existing_user_options(target_id):
-    print(f'''\n** Existing User Options **
+    say(f'''\n** Existing User Options **
     \nYou're an existing user! Here are some options:
     1. Manage Membership
     2. Profile Analytics
@@ -302,280 +882,487 @@ def existing_user_options(target_id):
     6. Find best time to go to gym
     7. FAQs''')
     
-    choice = input("Please choose an option (1/2/3/4/5/6/7): ")
+    choice = (yield "Please choose an option (1/2/3/4/5/6/7): ")
     
     if choice == "1":
-        manage_membership(target_id)
-        repeat_trigger_existing_user_flow(target_id)
+        yield from manage_membership(target_id)
     elif choice == "2":
-        print("Here's information about your profile.")
+        say("Here's information about your profile.")
         calculate_macronutrients(target_id)
         analyze_gym_usage(target_id)
-        repeat_trigger_existing_user_flow(target_id)
     elif choice == "3":
-        input_for_nearest_gym()
-        repeat_trigger_existing_user_flow(target_id)
+        yield from input_for_nearest_gym()
     elif choice == "4":
-        input_for_sentiment_analysis(target_id)
-        repeat_trigger_existing_user_flow(target_id)
+        yield from input_for_sentiment_analysis(target_id)
     elif choice == "5":
-        suggest_exercises()
-        repeat_trigger_existing_user_flow(target_id)
+        yield from suggest_exercises()
     elif choice == "6":
-        gym_occupancy()
-        repeat_trigger_existing_user_flow(target_id)
+        yield from gym_occupancy()
     elif choice == "7":
-        query1 = input("\nEnter your query: ")
+        query1 = (yield "\nEnter your query: ")
         gym_faq(query1)
-        repeat_trigger_existing_user_flow(target_id)     
     else:
-        print("Sorry, we couldn't understand your choice.")
-        repeat_trigger_existing_user_flow(target_id)
+        say("Sorry, we couldn't understand your choice.")
+    return partial(repeat_trigger_existing_user_flow, target_id)
         
 
 #5. Function to handle manage membership options - handles pause, cancel, or transfer membership
 
 def manage_membership(target_id):
-    df = pd.read_excel('user_data.xlsx')
-    #df = df.astype(str)
-    reply=input("\nWould you like to pause,cancel,reactivate or transfer your membership: ").lower()
-    if 'pause' in reply:
-        condition=df['customerId']==target_id
-        # Find the index of the row that matches the condition
-        row_index = df[condition].index[0]
-        df.at[row_index, 'status'] = "Paused"
-        print("We have successfully paused your membership. Your automatic billing will stop at the end of this month, access on your key has also been paused")
-    elif 'cancel' in reply:
-        print("You also have the option to pause your membership. Would you like to do that instead?")
-        y_n=input("Enter yes/no :").lower()
-        if 'yes' in y_n:
-            print("Taking you back to manage membership page, hope to see you again at anytimefitness!")
-            return manage_membership(target_id)
-        else:
-            reason=input("Please enter reason for cancellation").lower()
-            condition=df['customerId']==target_id
-            # Find the index of the row that matches the condition
-            row_index = df[condition].index[0]
-            df.at[row_index, 'status'] = "Cancel"
-            df.at[row_index, 'cancelReason'] = reason
-            print("We are sorry to see you go! please return your key to your home gym to complete the process, you have been a valued customer.")
-    elif 'reactivate' in reply:
-        condition=df['customerId']==target_id
-        # Find the index of the row that matches the condition
-        row_index = df[condition].index[0]
-        if df.at[row_index, 'status'] == "Active":
-            print("You are already an active member!")
-        else:
-            df.at[row_index, 'status'] = "Active"
-            print("We have successfully reactivated your membership. Your automatic billing will start from today, access on your key has also been activated")
-    elif 'transfer' in reply:
-        first_name = input("What's the transfer members first name? ")
-        last_name = input("What's the transfer members last name? ")
-        while True:
-            email = input("What's their email address? ")
-            if not validate_email(email):
-                print("Invalid email format. Please enter a valid email address.")
+    user_repo = get_user_repository()
+    while True:
+        reply=(yield "\nWould you like to pause,cancel,reactivate or transfer your membership: ").lower()
+        if 'pause' in reply:
+            user_repo.update(target_id, {'status': "Paused"})
+            say("We have successfully paused your membership. Your automatic billing will stop at the end of this month, access on your key has also been paused")
+        elif 'cancel' in reply:
+            say("You also have the option to pause your membership. Would you like to do that instead?")
+            y_n=(yield "Enter yes/no :").lower()
+            if 'yes' in y_n:
+                say("Taking you back to manage membership page, hope to see you again at anytimefitness!")
+                continue
             else:
-                break
-
-        while True:
-            phone_number = input("What's their phone number? ")
-            if not validate_phone_number(phone_number):
-                print("Invalid phone number format. Please enter a valid phone number.")
+                reason=(yield "Please enter reason for cancellation").lower()
+                user_repo.update(target_id, {'status': "Cancel", 'cancelReason': reason})
+                say("We are sorry to see you go! please return your key to your home gym to complete the process, you have been a valued customer.")
+        elif 'reactivate' in reply:
+            if user_repo.get(target_id)['status'] == "Active":
+                say("You are already an active member!")
             else:
-                break
+                user_repo.update(target_id, {'status': "Active"})
+                say("We have successfully reactivated your membership. Your automatic billing will start from today, access on your key has also been activated")
+        elif 'transfer' in reply:
+            first_name = (yield "What's the transfer members first name? ")
+            last_name = (yield "What's the transfer members last name? ")
+            while True:
+                email = (yield "What's their email address? ")
+                if not validate_email(email):
+                    say("Invalid email format. Please enter a valid email address.")
+                else:
+                    break
 
-        while True:
-            zipcode = input("What's their zipcode? ")
-            if not validate_zipcode(zipcode):
-                print("Invalid zipcode format. Please enter a valid zipcode.")
-            else:
-                break
-        condition=df['customerId']==target_id
-        # Find the index of the row that matches the condition
-        row_index = df[condition].index[0]
-        df.at[row_index, 'first_name'] = first_name
-        df.at[row_index, 'last_name'] = last_name
-        df.at[row_index, 'email'] = email
-        df.at[row_index, 'phone'] = phone_number
-        df.at[row_index, 'zipcode'] = zipcode
-        df.at[row_index, 'status'] = "Transfer"
-        print("We have successfully transferred your account. The transferred member will be able to use the gym till your membership expires at the end of the year, they can then choose to renew it")
-    
-    df.to_excel('user_data.xlsx',index=False)
+            while True:
+                phone_number = (yield "What's their phone number? ")
+                if not validate_phone_number(phone_number):
+                    say("Invalid phone number format. Please enter a valid phone number.")
+                else:
+                    break
+
+            while True:
+                zipcode = (yield "What's their zipcode? ")
+                if not validate_zipcode(zipcode):
+                    say("Invalid zipcode format. Please enter a valid zipcode.")
+                else:
+                    break
+            user_repo.update(target_id, {
+                'first_name': first_name,
+                'last_name': last_name,
+                'email': email,
+                'phone': phone_number,
+                'zipcode': zipcode,
+                'status': "Transfer"
+            })
+            say("We have successfully transferred your account. The transferred member will be able to use the gym till your membership expires at the end of the year, they can then choose to renew it")
+        break
 
 
 #6.1 Profile Analytics 1 - Function to calculate macronutrients levels for a user
 
 def calculate_macronutrients(target_id):
-    df = pd.read_excel('user_data.xlsx')
-    target_df = df[df.customerId == target_id]
-    gender = target_df.iloc[0]['gender']
-    age = target_df.iloc[0]['age']
-    weight = target_df.iloc[0]['weight']
-    height = target_df.iloc[0]['height']
-    activity_level = target_df.iloc[0]['activity_level']
-       
-    # Macronutrient ratios based on activity level
-    activity_levels = {
-        'low': {'carbs': 45, 'protein': 25, 'fat': 30},
-        'moderate': {'carbs': 50, 'protein': 30, 'fat': 20},
-        'active': {'carbs': 55, 'protein': 35, 'fat': 10}
-    }
-
-    # Calculate macronutrient values
-    activity_ratio = activity_levels.get(activity_level.lower())
-    if not activity_ratio:
-        print(f"Invalid activity level: {activity_level}")
+    user = get_user_repository().get(target_id)
+    macros = cached_macronutrients(user['gender'], user['age'], user['weight'], user['height'], user['activity_level'])
+    if macros is None:
+        say(f"Invalid activity level: {user['activity_level']}")
         return None
 
-    total_calories = 10 * weight + 6.25 * height - 5 * age + 5
-    carb_calories = (activity_ratio['carbs'] / 100) * total_calories
-    protein_calories = (activity_ratio['protein'] / 100) * total_calories
-    fat_calories = (activity_ratio['fat'] / 100) * total_calories
+    say("Your macronutrient levels are: \n")
+    for nutrient, grams in zip(['Carbohydrates', 'Protein', 'Fat'], macros[1:]):
+        say(f'''{nutrient}: {grams:.2f} gm''')
 
-    # Convert calories to grams
-    carb_grams = carb_calories / 4
-    protein_grams = protein_calories / 4
-    fat_grams = fat_calories / 9
 
-    # Create a DataFrame to store the results
-    nutrient_data = {
-        'Nutrient': ['Carbohydrates', 'Protein', 'Fat'],
-        'Grams': [carb_grams, protein_grams, fat_grams]
-    }
+#6.1.1 Profile Analytics 1 - Function to calculate the daily calories and macronutrients of many members in one vectorized pass
+# Calories are the Mifflin-St Jeor BMR, 10 * weight + 6.25 * height - 5 * age, plus 5 for men and minus 161 for women, split by the
+# MACRO_RATIOS of the member's activity level (4 calories per gram of carbs or protein, 9 per gram of fat). Members with an unknown
+# activity level get NaN macronutrients. The result has the same index as members
+
+def compute_macronutrients(members):
+    activity = members['activity_level'].astype(str).str.strip().str.lower()
+    ratios = pd.DataFrame.from_dict(MACRO_RATIOS, orient='index').reindex(activity.to_numpy()) / 100
+    female = members['gender'].astype(str).str.strip().str.lower().isin(['female', 'f']).to_numpy()
+    numbers = {column: pd.to_numeric(members[column], errors='coerce').to_numpy(dtype='float64') for column in ['weight', 'height', 'age']}
     
-    nutrient_df = pd.DataFrame(nutrient_data)
-    print("Your macronutrient levels are: \n")
-    for i in range(len(nutrient_df)):
-        print(f'''{nutrient_df.iloc[i]['Nutrient']}: {nutrient_df.iloc[i]['Grams']:.2f} gm''')    
+    calories = 10 * numbers['weight'] + 6.25 * numbers['height'] - 5 * numbers['age'] + np.where(female, -161, 5)
+    return pd.DataFrame({
+        'calories': calories,
+        'carbs_g': ratios['carbs'].to_numpy() * calories / 4,
+        'protein_g': ratios['protein'].to_numpy() * calories / 4,
+        'fat_g': ratios['fat'].to_numpy() * calories / 9
+    }, index=members.index)
+
+
+#6.1.2 Profile Analytics 1 - Function to return one member's (calories, carbs, protein, fat), or None for an unknown activity level
+# Cached by the member's details, so a member whose weight or activity level changes is recalculated
+
+@lru_cache(maxsize=4096)
+def cached_macronutrients(gender, age, weight, height, activity_level):
+    member = pd.DataFrame({'gender': [gender], 'age': [age], 'weight': [weight], 'height': [height], 'activity_level': [activity_level]})
+    macros = compute_macronutrients(member).iloc[0]
+    if np.isnan(macros['carbs_g']):
+        return None
+    return tuple(float(value) for value in macros[['calories', 'carbs_g', 'protein_g', 'fat_g']])
+
+
+#6.1.3 Command to write the daily calories and macronutrients of every member to a csv in one batch
+# e.g. python insy660_merged_v4.py nutrition-report, or python insy660_merged_v4.py nutrition-report report.csv
+
+def nutrition_report_command(args):
+    path = args[0] if args else NUTRITION_REPORT_FILE
+    members = get_user_repository().all()
+    report = pd.concat([members[['customerId', 'first_name', 'last_name', 'gender', 'activity_level']], compute_macronutrients(members)], axis=1)
+    report.to_csv(path, index=False, float_format='%.2f')
+    invalid = int(report['carbs_g'].isna().sum())
+    print(f"Nutrition report for {len(report)} members saved to {path}" + (f", {invalid} without a valid activity level" if invalid else ""))
 
 
 #6.2 Profile Analytics 2 - Function to Display chart for daily gym usage of a user
 
 def analyze_gym_usage(target_id):
     # Read the CSV file into a DataFrame
-    df = pd.read_csv('gym_usage_2.csv')
-    df2 = pd.read_excel('user_data.xlsx')
-    target_df = df2[df2.customerId == target_id]
-    name = target_df.iloc[0]['first_name']
+    df = load_data(GYM_USAGE_FILE)
+    name = get_user_repository().get(target_id)['first_name']
     # Filter data for the specified GymID
-    gym_data = df[df['customerId'] == target_id]
+    gym_data = df[df['customerId'] == target_id].copy()
     # Calculate total hours spent at the gym
     #gym_data['Session Duration (hours)'] = gym_data['Session Duration (hours)'].str.replace(',', '.').astype(float)
     total_hours = gym_data['Session Duration (hours)'].sum()
 
-    # Create a bar chart of workout time by day
+    # Create a bar chart of workout time by day - on screen in the terminal, saved to CHART_DIR for headless sessions
+    session = current_session()
+    interactive = session is None or session.interactive
     gym_data['Date'] = pd.to_datetime(gym_data['Date'])
     grouped = gym_data.groupby('Date').sum()
-    plt.bar(grouped.index, grouped['Session Duration (hours)'],color='purple')
-    plt.xlabel('Date')
-    plt.ylabel('Total Hours')
-    plt.title(f"Daily Workout Time for {name}")
-    plt.xticks(rotation=45)
-    plt.tight_layout()
+    if interactive:
+        fig, ax = plt.subplots()
+    else:
+        from matplotlib.figure import Figure
+        fig = Figure()
+        ax = fig.subplots()
+    ax.bar(grouped.index, grouped['Session Duration (hours)'],color='purple')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Total Hours')
+    ax.set_title(f"Daily Workout Time for {name}")
+    ax.tick_params(axis='x', rotation=45)
+    fig.tight_layout()
 
     # Show the bar chart
-    plt.show()
-    print(f"\nTotal hours spent in gym by {name}: {total_hours:.2f} hours")
+    if interactive:
+        plt.show()
+    else:
+        os.makedirs(CHART_DIR, exist_ok=True)
+        chart_file = os.path.join(CHART_DIR, f"{target_id}_{session.id}.png")
+        fig.savefig(chart_file)
+        say(f"Your daily workout chart is available at {chart_file}")
+    say(f"\nTotal hours spent in gym by {name}: {total_hours:.2f} hours")
         
 
 #7.1 - Find nearest gym 1 - Function to calculate aerial distance between two latitude, longitude coordinates    
+# Works on scalars or on numpy arrays, arrays are compared element by element (and broadcast, see haversine_matrix)
 
 def find_aerial_distance(lat1, lon1, lat2, lon2):
     # Radius of the Earth in km
     R = 6371.0
     
     # Convert degrees to radians
-    lat1 = math.radians(lat1)
-    lon1 = math.radians(lon1)
-    lat2 = math.radians(lat2)
-    lon2 = math.radians(lon2)
+    lat1 = np.radians(lat1)
+    lon1 = np.radians(lon1)
+    lat2 = np.radians(lat2)
+    lon2 = np.radians(lon2)
     
     # Differences in coordinates
     dlat = lat2 - lat1
     dlon = lon2 - lon1
     
     # Haversine formula
-    a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
     distance = R * c
     
     return distance
 
 
-#7.2 - Find nearest gym 2 - Function to filter available amenities in gym based on user input
+#7.1.1 - Find nearest gym 1.1 - Function to calculate the distance matrix in km between every origin and every destination
 
-def has_amenities(row,am_list):
-    amenities = set(row['amenities'].lower().split(', '))
-    return any(item in amenities for item in am_list)
+def haversine_matrix(origin_lat, origin_long, dest_lat, dest_long):
+    origin_lat = np.asarray(origin_lat, dtype=float)[:, None]
+    origin_long = np.asarray(origin_long, dtype=float)[:, None]
+    dest_lat = np.asarray(dest_lat, dtype=float)[None, :]
+    dest_long = np.asarray(dest_long, dtype=float)[None, :]
+    return find_aerial_distance(origin_lat, origin_long, dest_lat, dest_long)
 
 
-#7.3 - Find nearest gym 3 - Function that combines the nearest distance and required amenities to generate the list of available gym options for user
+#7.1.2 - Find nearest gym 1.2 - Function to find the k nearest destinations of every origin, returns (distances, destination positions) sorted nearest first
+# Origins are processed in chunks so the distance matrix never holds more than chunk_size x destinations values
 
-def find_nearest_gym(zipcode, amenities):
-    gym_master = pd.read_excel('gym_data.xlsx')
-    zip_mapping = pd.read_excel('zipcode_master.xlsx')
-    zip_list = zip_mapping['zipcode'].tolist()
-    cx_zip = zipcode[:3]
-    for i in range(len(zip_list)):
-        if(cx_zip==zip_list[i]):
-            break
-    cx_lat = zip_mapping.iloc[i]['lat']
-    cx_long = zip_mapping.iloc[i]['long']
-    gym_master['distance'] = 0
-    for i in range(len(gym_master)):
-        gym_master.at[i,'distance'] = find_aerial_distance(cx_lat,cx_long,gym_master.iloc[i]['lat'],gym_master.iloc[i]['long'])
-        
-    return gym_master
+def nearest_k(origin_lat, origin_long, dest_lat, dest_long, k=5, chunk_size=2048):
+    origin_lat = np.asarray(origin_lat, dtype=float)
+    origin_long = np.asarray(origin_long, dtype=float)
+    k = min(k, len(dest_lat))
+    distances = np.empty((len(origin_lat), k))
+    positions = np.empty((len(origin_lat), k), dtype=int)
+    
+    for start in range(0, len(origin_lat), chunk_size):
+        end = start + chunk_size
+        matrix = haversine_matrix(origin_lat[start:end], origin_long[start:end], dest_lat, dest_long)
+        candidates = np.argpartition(matrix, k - 1, axis=1)[:, :k]
+        candidate_distances = np.take_along_axis(matrix, candidates, axis=1)
+        order = np.argsort(candidate_distances, axis=1)
+        positions[start:end] = np.take_along_axis(candidates, order, axis=1)
+        distances[start:end] = np.take_along_axis(candidate_distances, order, axis=1)
+    
+    return distances, positions
+
+
+#7.2 - Find nearest gym 2 - Function to normalize a comma separated amenities text into a set of lowercase amenity names
+
+def parse_amenities(text):
+    return set(item.strip() for item in str(text).lower().split(',') if item.strip())
+
+
+#7.3 - Find nearest gym 3 - Function that finds the gyms nearest to the user's zipcode which offer any (or all, with match='all') of the required amenities
+
+def find_nearest_gym(zipcode, amenities, k=5, match='any'):
+    location = geocode_zipcode(zipcode)
+    if location is None:
+        return load_data(GYM_DATA_FILE).head(0).assign(distance=[])
+    cx_lat, cx_long = location
+    amenity_bits = None
+    if parse_amenities(amenities):
+        amenity_bits, unmatched = match_amenities(amenities)
+    return search_nearest_gyms(cx_lat, cx_long, amenity_bits, k, match)
 
 
 #7.4 - Find nearest gym 4 - Function to take user input for determining the nearest gym and display the results
 
 def input_for_nearest_gym():
-    zipcode = input("Enter your zipcode: ").upper()
-    amenities = input("Enter the gym amenities: ")
-
-    zip_mapping = pd.read_excel('zipcode_master.xlsx')
-    zip_list = zip_mapping['zipcode'].tolist()
-    cx_zip = zipcode[:3]
+    zipcode = (yield "Enter your zipcode: ").upper()
+    amenities = (yield "Enter the gym amenities: ")
 
-    if(cx_zip not in zip_list):
-        print("Sorry, we are not available in your location yet. We are constantly working to expand our network and will be available in your location soon!")
+    if(geocode_zipcode(zipcode) is None):
+        say("Sorry, we are not available in your location yet. We are constantly working to expand our network and will be available in your location soon!")
 
     else:
-        gym_master = find_nearest_gym(zipcode, amenities)
-        
-        cx_am = set(amenities.lower().split(', '))
-        gym_with_amenities = gym_master[gym_master.apply(has_amenities, args=(cx_am,), axis=1)]
-    
+        amenity_bits, unmatched = match_amenities(amenities)
+        if unmatched:
+            say(f"We don't know of any gyms offering: {', '.join(sorted(unmatched))}")
+        gym_with_amenities = find_nearest_gym(zipcode, amenities)
     
         if(len(gym_with_amenities)>0):
-            gym_with_amenities = gym_with_amenities.sort_values(by='distance').head(5)
-            print("The centers closest to your location are:\n")
-            for i in range(len(gym_with_amenities)):
-                text=f'''({i+1})
-Location: {gym_with_amenities.iloc[i]['address']}, {gym_with_amenities.iloc[i]['location']}, {gym_with_amenities.iloc[i]['zipCode']} 
-Amenities: {gym_with_amenities.iloc[i]['amenities']}
-Distance: {gym_with_amenities.iloc[i]['distance']:.2f} km
-\n'''
-                print(text)  
+            say("The centers closest to your location are:\n")
+            print_gyms(gym_with_amenities)
             
         else:            
-            text = "Sorry, there are no available gyms with the amenities you have requested. You can also check out these other gyms close to your location:\n\n" 
-            for i in range(5):
-                text=f'''({i+1})
-Location: {gym_master.iloc[i]['address']}, {gym_master.iloc[i]['location']}, {gym_master.iloc[i]['zipCode']} 
-Amenities: {gym_master.iloc[i]['amenities']}
-Distance: {gym_master.iloc[i]['distance']:.2f} km
+            say("Sorry, there are no available gyms with the amenities you have requested. You can also check out these other gyms close to your location:\n")
+            print_gyms(find_nearest_gym(zipcode, ''))
+
+
+#7.5 - Find nearest gym 5 - Function to print a numbered list of gyms with their distance
+
+def print_gyms(gyms):
+    for i in range(len(gyms)):
+        text=f'''({i+1})
+Location: {gyms.iloc[i]['address']}, {gyms.iloc[i]['location']}, {gyms.iloc[i]['zipCode']} 
+Amenities: {gyms.iloc[i]['amenities']}
+Distance: {gyms.iloc[i]['distance']:.2f} km
 \n'''
-                print(text)
+        say(text)
+
+
+#7.6 - Find nearest gym 6 - Function to build the gym index - the amenity vocabulary, a bitmask of amenities per gym,
+# a haversine BallTree over all gyms and one per amenity bit
+# It is rebuilt only when the data store hands back a new gym_data frame, i.e. when gym_data.xlsx has changed
+
+EARTH_RADIUS_KM = 6371.0
+_gym_index = None
+_gym_index_lock = threading.Lock()
+
+def load_gym_index():
+    global _gym_index
+    gyms = load_data(GYM_DATA_FILE)
+    with _gym_index_lock:
+        if _gym_index is not None and _gym_index['gyms'] is gyms:
+            return _gym_index
+        from sklearn.neighbors import BallTree
+        
+        amenity_sets = [parse_amenities(text) for text in gyms['amenities']]
+        vocabulary = sorted(set().union(*amenity_sets))
+        bits = {amenity: bit for bit, amenity in enumerate(vocabulary)}
+        masks = np.vstack([amenity_mask([bits[amenity] for amenity in amenity_set], len(vocabulary)) for amenity_set in amenity_sets])
+        
+        coords = np.radians(gyms[['lat', 'long']].to_numpy(dtype=float))
+        trees = {None: (np.arange(len(gyms)), BallTree(coords, metric='haversine'))}
+        for bit in range(len(vocabulary)):
+            positions = np.flatnonzero(filter_by_amenities(masks, amenity_mask([bit], len(vocabulary))))
+            trees[bit] = (positions, BallTree(coords[positions], metric='haversine'))
+        
+        _gym_index = {'gyms': gyms, 'vocabulary': vocabulary, 'bits': bits, 'masks': masks, 'trees': trees}
+        return _gym_index
+
+
+#7.7 - Find nearest gym 7 - Function to query the k nearest gyms offering any (match='any') or all (match='all') of the amenity bits
+# amenity_bits=None means no amenity filter, an empty list means nothing can match
+# For 'any' each amenity tree returns its own k nearest, so merging them gives the exact top k without scanning gyms that do not qualify
+# For 'all' the tree of the rarest amenity is searched with a growing k until enough of its gyms also have the other amenities
+
+def search_nearest_gyms(lat, long, amenity_bits=None, k=5, match='any'):
+    index = load_gym_index()
+    trees = index['trees']
+    point = np.radians([[lat, long]])
+    
+    nearest = {}
+    if amenity_bits is None or match == 'any':
+        for key in ([None] if amenity_bits is None else amenity_bits):
+            positions, tree = trees[key]
+            distances, found = tree.query(point, k=min(k, len(positions)))
+            for distance, position in zip(distances[0], positions[found[0]]):
+                nearest[position] = distance * EARTH_RADIUS_KM
+    elif amenity_bits:
+        query = amenity_mask(amenity_bits, len(index['vocabulary']))
+        positions, tree = min((trees[bit] for bit in amenity_bits), key=lambda entry: len(entry[0]))
+        k_search = k
+        while True:
+            distances, found = tree.query(point, k=min(k_search, len(positions)))
+            candidates = positions[found[0]]
+            qualifies = filter_by_amenities(index['masks'][candidates], query, match='all')
+            if qualifies.sum() >= k or k_search >= len(positions):
+                break
+            k_search *= 2
+        for distance, position in zip(distances[0][qualifies], candidates[qualifies]):
+            nearest[position] = distance * EARTH_RADIUS_KM
+    
+    best = sorted(nearest.items(), key=lambda item: item[1])[:k]
+    result = index['gyms'].iloc[[position for position, distance in best]].copy()
+    result['distance'] = find_aerial_distance(lat, long, result['lat'].to_numpy(), result['long'].to_numpy())
+    return result.reset_index(drop=True)
+
+
+#7.8 - Find nearest gym 8 - Function to find the k nearest gyms of every member in one pass, for marketing and home gym assignment jobs
+# Members whose zipcode cannot be geocoded get no gyms and are reported as unresolved
+
+def nearest_gyms_for_members(k=3):
+    members = get_user_repository().all()
+    gyms = load_data(GYM_DATA_FILE)
+    
+    locations = [geocode_zipcode(str(zipcode)) for zipcode in members['zipcode']]
+    located = pd.DataFrame([(customer_id,) + location for customer_id, location in zip(members['customerId'], locations) if location is not None],
+                           columns=['customerId', 'lat', 'long'])
+    distances, positions = nearest_k(located['lat'], located['long'], gyms['lat'], gyms['long'], k)
+    
+    result = pd.DataFrame({
+        'customerId': np.repeat(located['customerId'].to_numpy(), distances.shape[1]),
+        'rank': np.tile(np.arange(1, distances.shape[1] + 1), len(located)),
+        'gymId': gyms['gymId'].to_numpy()[positions.ravel()],
+        'distance': distances.ravel()
+    })
+    unresolved = sorted(set(members['customerId']) - set(located['customerId']))
+    return result, unresolved
+
+
+#7.9 - Find nearest gym 9 - Command to write the nearest gyms of every member to a csv, e.g. python insy660_merged_v4.py nearest-gyms 3
+
+def nearest_gyms_command(args):
+    k = int(args[0]) if args else 3
+    result, unresolved = nearest_gyms_for_members(k)
+    result.to_csv('member_nearest_gyms.csv', index=False)
+    print(f"Nearest {k} gyms for {result['customerId'].nunique()} members saved to member_nearest_gyms.csv")
+    if unresolved:
+        print(f"No location found for the zipcodes of {len(unresolved)} members: {', '.join(unresolved)}")
+
+
+#7.10 - Find nearest gym 10 - Function to build an amenity bitmask from bit positions, one uint64 word per 64 amenities
+
+def amenity_mask(amenity_bits, vocabulary_size):
+    mask = np.zeros(max(1, (vocabulary_size + 63) // 64), dtype=np.uint64)
+    for bit in amenity_bits:
+        mask[bit // 64] |= np.uint64(1 << (bit % 64))
+    return mask
+
+
+#7.11 - Find nearest gym 11 - Function to filter gym bitmasks with one vectorized bitwise operation, returns a boolean array per gym
+
+def filter_by_amenities(masks, query, match='any'):
+    overlap = masks & query
+    if match == 'all':
+        return (overlap == query).all(axis=-1)
+    return (overlap != 0).any(axis=-1)
+
+
+#7.12 - Find nearest gym 12 - Function to map free text amenities to vocabulary bits, with fuzzy matching for typos and near misses
+# Returns the list of bits and the set of amenities that matched nothing
+
+AMENITY_MATCH_CUTOFF = 0.75
+
+def match_amenities(text):
+    index = load_gym_index()
+    amenity_bits = []
+    unmatched = set()
+    for item in parse_amenities(text):
+        if item not in index['bits']:
+            close = difflib.get_close_matches(item, index['vocabulary'], n=1, cutoff=AMENITY_MATCH_CUTOFF)
+            if not close:
+                unmatched.add(item)
+                continue
+            item = close[0]
+        if index['bits'][item] not in amenity_bits:
+            amenity_bits.append(index['bits'][item])
+    return amenity_bits, unmatched
+
+
+#7.13 - Find nearest gym 13 - Function to build the geocoding tables - zipcode prefix -> (lat, long) from zipcode_master.xlsx,
+# and full postal code -> (lat, long) when POSTAL_CODE_FILE exists. Rebuilt only when the data store returns new frames
+
+_zip_index = None
+_zip_index_lock = threading.Lock()
+
+def normalize_zipcode(zipcode):
+    return re.sub(r"\s+", "", str(zipcode)).upper()
+
+def load_zip_index():
+    global _zip_index
+    zip_mapping = load_data(ZIPCODE_FILE)
+    postal_codes = load_data(POSTAL_CODE_FILE) if os.path.exists(POSTAL_CODE_FILE) else None
+    with _zip_index_lock:
+        if _zip_index is not None and _zip_index['zip_mapping'] is zip_mapping and _zip_index['postal_codes'] is postal_codes:
+            return _zip_index
+        
+        prefixes = {normalize_zipcode(zipcode): (float(lat), float(long)) for zipcode, lat, long in zip_mapping[['zipcode', 'lat', 'long']].itertuples(index=False)}
+        full_codes = {}
+        if postal_codes is not None:
+            full_codes = {normalize_zipcode(code): (float(lat), float(long)) for code, lat, long in postal_codes[['postalCode', 'lat', 'long']].itertuples(index=False)}
+        
+        _zip_index = {'zip_mapping': zip_mapping, 'postal_codes': postal_codes, 'prefixes': prefixes, 'full_codes': full_codes}
+        cached_geocode.cache_clear()
+        return _zip_index
+
+
+#7.14 - Find nearest gym 14 - Function to geocode a zipcode to (lat, long) - full postal code first, then its 3 character prefix
+# Returns None when neither is known, callers must treat that as "not available in your location"
+
+@lru_cache(maxsize=4096)
+def cached_geocode(zipcode):
+    index = _zip_index
+    if zipcode in index['full_codes']:
+        return index['full_codes'][zipcode]
+    return index['prefixes'].get(zipcode[:3])
+
+def geocode_zipcode(zipcode):
+    load_zip_index()
+    return cached_geocode(normalize_zipcode(zipcode))
 
 
 #8.1 Function analyzes the sentiment of a given text and provides a compound sentiment score to convey the text's overall positive, negative, or neutral sentiment.
 
 def analyze_sentiment(text):
-    sia = SentimentIntensityAnalyzer()
+    sia = get_sentiment_analyzer()
     sentiment_scores = sia.polarity_scores(text)
     return sentiment_scores['compound']
 
@@ -590,266 +1377,1645 @@ def map_review_score_to_rating(review_score):
 #8.3 Function suggests a suitable gym trainer from a dataset by analyzing user requirements using sentiment analysis and cosine similarity, returning the best-matched trainer's details. 
 
 def recommend_trainer(user_req, trainers_df):
-    sia = SentimentIntensityAnalyzer()
-    reviews_df = pd.read_csv('gym_trainer_reviews.csv')
-    user_req = user_req.lower()
+    matches = top_trainers(user_req, trainers_df, k=1)
+    if len(matches) == 0:
+        return None
+    return matches.iloc[0]
 
-    vectorizer = CountVectorizer()
-    spec_matrix = vectorizer.fit_transform(trainers_df['Specialization'].str.lower()).toarray()
 
-    user_vector = vectorizer.transform([user_req]).toarray()
+#8.4 Function reads user data and recommends a trainer based on their requirement, updating the data with the assigned trainer's name and saving it back to an Excel file.
+
+def input_for_sentiment_analysis(target_id):
+    trainers_df = load_trainer_ratings()
 
-    cosine_sim = cosine_similarity(user_vector, spec_matrix)[0]
-    sorted_indices = cosine_sim.argsort()[::-1]
+    assigned_trainers = trainer_loads()
 
-    best_match = None
-    for idx in sorted_indices:
-        if trainers_df['Review_Score'][idx] == trainers_df['Review_Score'][sorted_indices[0]]:
-            best_match = trainers_df.iloc[idx]
+    while True:
+        user_req = (yield "Please enter your trainer requirement (e.g., yoga, weight training, cardio): ").lower()
+        if user_req in trainers_df['Specialization'].tolist():
             break
+        say("Sorry, you seem to have entered an incorrect gymId. Please try again")
 
-    return best_match
+    k = TRAINER_SEARCH_K
+    while True:
+        matches = top_trainers(user_req, trainers_df, k=k)
+        available = matches[matches['Name'].map(lambda name: assigned_trainers.get(name, 0) < TRAINER_CAPACITY)]
+        # Fewer than k matches means every trainer with that specialization has been looked at
+        if len(available) > 0 or len(matches) < k:
+            break
+        k *= 2
+    matched_trainer = available.iloc[0] if len(available) > 0 else None
+    if matched_trainer is not None:
+        say("We found a trainer for you!")
+        say("Trainer Name:", matched_trainer["Name"])
+        say("Specialization:", matched_trainer["Specialization"])
+        say("Age:", matched_trainer["Age"])
+        say("Rating:", matched_trainer["Rating"])
+        get_user_repository().update(target_id, {'trainer': matched_trainer['Name']})
+    else:
+        say("Sorry, no available trainers match your requirement.")
 
 
-#8.4 Function reads user data and recommends a trainer based on their requirement, updating the data with the assigned trainer's name and saving it back to an Excel file.
+#8.5 Function to return the shared VADER analyzer, the lexicon is loaded once instead of once per review
 
-def input_for_sentiment_analysis(target_id):
-    df = pd.read_excel('user_data.xlsx')
-    trainers_df = pd.read_csv('gym_trainers_dataset.csv')
-    reviews_df = pd.read_csv('gym_trainer_reviews.csv')
-
-    reviews_df['Review_Score'] = reviews_df['Review'].apply(analyze_sentiment)
-
-    trainers_df = trainers_df.merge(reviews_df.groupby('Trainer')['Review_Score'].mean(), left_on='Name', right_on='Trainer', how='left')
-
-    trainers_df['Review_Score'].fillna(0, inplace=True)
-    trainers_df['Rating'] = trainers_df['Review_Score'].apply(map_review_score_to_rating)
-
-    assigned_trainers = set()
-
-    user_req = input("Please enter your trainer requirement (e.g., yoga, weight training, cardio): ").lower()
-    if user_req in trainers_df['Specialization'].tolist():
-        matched_trainer = recommend_trainer(user_req, trainers_df)
-        if matched_trainer is not None:
-            print("We found a trainer for you!")
-            print("Trainer Name:", matched_trainer["Name"])
-            print("Specialization:", matched_trainer["Specialization"])
-            print("Age:", matched_trainer["Age"])
-            print("Rating:", matched_trainer["Rating"])
-            df.loc[df['customerId']==target_id,'trainer'] = matched_trainer['Name']
-            df.to_excel('user_data.xlsx',index=False)
-        else:
-            print("Sorry, no available trainers match your requirement.")
-    else:
-        print("Sorry, you seem to have entered an incorrect gymId. Please try again")
-        input_for_sentiment_analysis(target_id)
+_sentiment_analyzer = None
+_sentiment_lock = threading.Lock()
+
+def get_sentiment_analyzer():
+    global _sentiment_analyzer
+    with _sentiment_lock:
+        if _sentiment_analyzer is None:
+            from nltk.sentiment.vader import SentimentIntensityAnalyzer
+            _sentiment_analyzer = SentimentIntensityAnalyzer()
+        return _sentiment_analyzer
+
+
+#8.6 Function to score reviews through the review score cache - reviews are keyed by a sha1 of their text, only reviews
+# missing from the cache are scored and they are appended to REVIEW_SCORE_CACHE_FILE for the next run
+
+_review_scores = None
+
+def review_hash(text):
+    return hashlib.sha1(str(text).encode('utf-8')).hexdigest()
+
+def score_reviews(reviews):
+    global _review_scores
+    with _sentiment_lock:
+        if _review_scores is None:
+            _review_scores = {}
+            if os.path.exists(REVIEW_SCORE_CACHE_FILE):
+                cached = pd.read_csv(REVIEW_SCORE_CACHE_FILE)
+                _review_scores = dict(zip(cached['review_hash'], cached['Review_Score']))
+    
+    hashes = [review_hash(text) for text in reviews]
+    new_reviews = {digest: text for digest, text in zip(hashes, reviews) if digest not in _review_scores}
+    if new_reviews:
+        new_scores = {digest: analyze_sentiment(text) for digest, text in new_reviews.items()}
+        with _sentiment_lock:
+            _review_scores.update(new_scores)
+            pd.DataFrame({'review_hash': list(new_scores), 'Review_Score': list(new_scores.values())}).to_csv(
+                REVIEW_SCORE_CACHE_FILE, mode='a', index=False, header=not os.path.exists(REVIEW_SCORE_CACHE_FILE))
+    
+    return pd.Series([_review_scores[digest] for digest in hashes], index=getattr(reviews, 'index', None), dtype=float)
 
 
-#9. Function to recommend exercise based on user input for muscle. This function calls an external api to generate the recommendation
+#8.7 Function to return the trainers with their average review score and rating, recomputed only when the trainer or review files change
+
+_trainer_ratings = None
+
+def load_trainer_ratings():
+    global _trainer_ratings
+    trainers_df = load_data(TRAINERS_FILE)
+    reviews_df = load_data(REVIEWS_FILE)
+    if _trainer_ratings is not None and _trainer_ratings['trainers'] is trainers_df and _trainer_ratings['reviews'] is reviews_df:
+        return _trainer_ratings['ratings']
+    
+    scores = reviews_df[['Trainer']].assign(Review_Score=score_reviews(reviews_df['Review']))
+    ratings = trainers_df.merge(scores.groupby('Trainer')['Review_Score'].mean(), left_on='Name', right_on='Trainer', how='left')
+    ratings['Review_Score'] = ratings['Review_Score'].fillna(0)
+    ratings['Rating'] = ratings['Review_Score'].apply(map_review_score_to_rating)
+    
+    _trainer_ratings = {'trainers': trainers_df, 'reviews': reviews_df, 'ratings': ratings}
+    return ratings
+
+
+#8.8 Function to build the trainer matching index - a sparse TF-IDF matrix of word 1-2 grams over the specializations
+# The rows are L2 normalized, so a sparse dot product with a query vector is the cosine similarity. Rebuilt only when a new trainers frame is passed in
+
+_trainer_index = None
+_trainer_index_lock = threading.Lock()
+
+def load_trainer_index(trainers_df):
+    global _trainer_index
+    with _trainer_index_lock:
+        if _trainer_index is not None and _trainer_index['trainers'] is trainers_df:
+            return _trainer_index
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        vectorizer = TfidfVectorizer(ngram_range=(1, 2))
+        matrix = vectorizer.fit_transform(trainers_df['Specialization'].str.lower()).tocsr()
+        _trainer_index = {'trainers': trainers_df, 'vectorizer': vectorizer, 'matrix': matrix}
+        return _trainer_index
+
+
+#8.9 Function to return the top k trainers for a requirement, ranked by a blend of specialization similarity and review score
+# Only trainers with some similarity are returned, TRAINER_RATING_WEIGHT sets how much the review score counts against the similarity
+# The blend uses the average review score rescaled to 0-1 rather than the rounded 1-5 rating, on which most trainers tie, and
+# remaining ties go to the trainer listed first in TRAINERS_FILE
+
+TRAINER_RATING_WEIGHT = 0.2
+
+def trainer_review_scores(trainers_df):
+    return (trainers_df['Review_Score'].to_numpy(dtype=float) + 1) / 2
+
+def top_trainers(user_req, trainers_df, k=5):
+    index = load_trainer_index(trainers_df)
+    query = index['vectorizer'].transform([user_req.lower()])
+    similarity = (index['matrix'] @ query.T).toarray().ravel()
+    
+    candidates = np.flatnonzero(similarity > 0)
+    if len(candidates) == 0:
+        return trainers_df.head(0).assign(similarity=[], match_score=[])
+    ratings = trainer_review_scores(trainers_df)[candidates]
+    scores = (1 - TRAINER_RATING_WEIGHT) * similarity[candidates] + TRAINER_RATING_WEIGHT * ratings
+    
+    # Every candidate tied with the k-th best score is kept before sorting, so which of them make the top k does not depend on argpartition
+    k = min(k, len(candidates))
+    threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+    best = np.flatnonzero(scores >= threshold)
+    best = best[np.lexsort((candidates[best], -scores[best]))][:k]
+    return trainers_df.iloc[candidates[best]].assign(similarity=similarity[candidates[best]], match_score=scores[best])
+
+
+#8.10 Function to count how many members are currently assigned to each trainer
+
+def trainer_loads():
+    trainers = get_user_repository().all()['trainer']
+    trainers = trainers[trainers.notna() & (trainers != 'NA')]
+    return trainers.value_counts().to_dict()
+
+
+#8.11 Function to assign trainers to many members at once - all requirements are scored against the trainer index in one
+# sparse matrix product per chunk, then members are given their best trainer that still has capacity, in file order. Only the
+# trainers matching a member's requirement are ranked, so memory grows with the matches rather than chunk_size x trainers
+# Only the last request of a member is kept, and a member's current trainer is released only once they get a new one
+# The assignments are written back with a single repository transaction
+
+def assign_trainers_bulk(requests_df, capacity=TRAINER_CAPACITY, chunk_size=5000):
+    trainers_df = load_trainer_ratings()
+    index = load_trainer_index(trainers_df)
+    user_repo = get_user_repository()
+    
+    current = user_repo.all().set_index('customerId')['trainer']
+    requests_df = requests_df[requests_df['customerId'].isin(current.index)]
+    requests_df = requests_df.drop_duplicates('customerId', keep='last').reset_index(drop=True)
+    loads = trainer_loads()
+    ratings = trainer_review_scores(trainers_df)
+    names = trainers_df['Name'].to_numpy()
+    
+    assignments = {}
+    for start in range(0, len(requests_df), chunk_size):
+        chunk = requests_df.iloc[start:start + chunk_size]
+        queries = index['vectorizer'].transform(chunk['requirement'].astype(str).str.lower())
+        # The product stays sparse, each row only holds the trainers sharing a term with the requirement
+        similarity = (queries @ index['matrix'].T).tocsr()
+        similarity.sort_indices()
+        for row, customer_id in enumerate(chunk['customerId']):
+            previous = current[customer_id]
+            row_start, row_end = similarity.indptr[row], similarity.indptr[row + 1]
+            positions = similarity.indices[row_start:row_end]
+            scores = (1 - TRAINER_RATING_WEIGHT) * similarity.data[row_start:row_end] + TRAINER_RATING_WEIGHT * ratings[positions]
+            for position in positions[np.argsort(-scores, kind='stable')]:
+                name = names[position]
+                if name == previous:
+                    # Keeping the current trainer uses the slot the member already holds
+                    assignments[customer_id] = name
+                    break
+                if loads.get(name, 0) < capacity:
+                    loads[name] = loads.get(name, 0) + 1
+                    if previous in loads:
+                        loads[previous] -= 1
+                    assignments[customer_id] = name
+                    break
+    
+    user_repo.update_many({customer_id: {'trainer': name} for customer_id, name in assignments.items()})
+    result = requests_df.assign(trainer=requests_df['customerId'].map(assignments))
+    return result
+
+
+#8.12 Command to assign trainers from a csv of customerId,requirement rows, e.g. python insy660_merged_v4.py assign-trainers onboarding.csv
+
+def assign_trainers_command(args):
+    requests_df = pd.read_csv(args[0])
+    capacity = int(args[1]) if len(args) > 1 else TRAINER_CAPACITY
+    start = datetime.now()
+    result = assign_trainers_bulk(requests_df, capacity)
+    seconds = (datetime.now() - start).total_seconds()
+    result.to_csv('trainer_assignments.csv', index=False)
+    assigned = result['trainer'].notna().sum()
+    print(f"Assigned {assigned} of {len(requests_df)} members in {seconds:.2f}s ({len(requests_df) / max(seconds, 1e-9):.0f} members/s), results saved to trainer_assignments.csv")
+    if len(result) < len(requests_df):
+        print(f"Skipped {len(requests_df) - len(result)} rows with unknown customer ids or an earlier request of a repeated customer id")
+    if assigned < len(result):
+        print(f"{len(result) - assigned} members could not be matched, no trainer with that specialization has free capacity")
+
+
+#9. Function to recommend exercise based on user input for muscle. The exercises come from the local wger mirror, or from the wger api when there is no mirror
 
 def suggest_exercises():
+    pattern = re.compile(r'<.*?>')
     try:
-        pattern = re.compile(r'<.*?>')
-        var = input("\nWhat muscles are you planning to workout on?(For eg. Biceps, Shoulders, Triceps etc)\nPlease enter your choice: ").capitalize()
-        url = 'https://wger.de/api/v2/muscle'  
-        response = requests.get(url)
-        data = response.json()
-        results = data['results']
-        df_muscles = pd.DataFrame(results)
-        if var in df_muscles['name_en'].tolist():
-            mid = df_muscles.loc[df_muscles['name_en'] == var, 'id'].values[0]
-            url = f'https://wger.de/api/v2/exercise/?muscles={mid}&language=2'  
-            response = requests.get(url)
-            data = response.json()
-            results = data['results']
-            dfex = pd.DataFrame(results)
-            dfex = dfex.sort_values(by='id').head(5).reset_index(drop=True)
-            print(f"\nThe following are the recommended exercises to workout your {var}: \n")
-            for i in range(len(dfex)):
-                url = f"https://wger.de/api/v2/exerciseimage/?is_main=True&exercise_base={dfex.iloc[i]['exercise_base']}"
-                response = requests.get(url)
-                data = response.json()
-                results = data['results']
-                dfim = pd.DataFrame(results)
-                if(len(dfim)>0):
-                    img_url = dfim.iloc[0]['image']
-                else:
-                    img_url = 'Image not available'
-                text= f'''Exercise Name: {dfex.iloc[i]['name']}
-Description: {re.sub(pattern, '', dfex.iloc[i]['description'])}
-Image: {img_url}\n'''
-                print(text)
-        else:
-            print("\nSorry, you seem to have entered an invalid input. Please try again\n")
-            suggest_exercises()
-    except:
-        print("\nSorry, we encountered an internal error. Please try again.\n")
-        suggest_exercises()
+        muscles = wger_muscles()
+        while True:
+            var = (yield "\nWhat muscles are you planning to workout on?(For eg. Biceps, Shoulders, Triceps etc)\nPlease enter your choice: ").capitalize()
+            if var in muscles:
+                break
+            say("\nSorry, you seem to have entered an invalid input. Please try again\n")
+
+        exercises = wger_exercises(muscles[var])
+        say(f"\nThe following are the recommended exercises to workout your {var}: \n")
+        for exercise in exercises:
+            text= f'''Exercise Name: {exercise['name']}
+Description: {re.sub(pattern, '', exercise['description'] or '')}
+Image: {exercise['image'] or 'Image not available'}\n'''
+            say(text)
+    except (requests.RequestException, ValueError, KeyError, OSError):
+        say("\nSorry, we encountered an internal error. Please try again.\n")
+
+
+#9.1 Function to call a wger api endpoint over the shared session, responses are kept in memory for WGER_CACHE_TTL
+
+_wger_cache = {}
+_wger_lock = threading.Lock()
+
+def wger_get(url, params=None):
+    if not url.startswith('http'):
+        url = f"{WGER_BASE_URL}/{url}"
+    key = url + '?' + urlencode(sorted((params or {}).items()))
+    with _wger_lock:
+        cached = _wger_cache.get(key)
+        if cached is not None and cached['expires_at'] > datetime.now():
+            return cached['data']
+    response = get_wger_session().get(url, params=params, timeout=WGER_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
+    with _wger_lock:
+        _wger_cache[key] = {'expires_at': datetime.now() + WGER_CACHE_TTL, 'data': data}
+    return data
+
+
+#9.2 Function to fetch every page of a wger endpoint by following the 'next' links
+
+def wger_get_all(endpoint, params=None):
+    data = wger_get(endpoint, dict(params or {}, limit=100))
+    results = list(data['results'])
+    while data.get('next'):
+        data = wger_get(data['next'])
+        results.extend(data['results'])
+    return results
+
+
+#9.3 Function to refresh the local wger mirror - muscles, english exercises and main exercise images
+
+def sync_wger_mirror():
+    executor = get_wger_executor()
+    muscles = executor.submit(wger_get_all, 'muscle/')
+    exercises = executor.submit(wger_get_all, 'exercise/', {'language': 2})
+    images = executor.submit(wger_get_all, 'exerciseimage/', {'is_main': 'True'})
+    mirror = {
+        'synced_at': datetime.now().isoformat(),
+        'source': WGER_BASE_URL,
+        'muscles': muscles.result(),
+        'exercises': exercises.result(),
+        'images': images.result()
+    }
+    tmp_file = WGER_MIRROR_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(mirror, f)
+    os.replace(tmp_file, WGER_MIRROR_FILE)
+    return mirror
+
+
+#9.3.1 Function to return the shared wger session - keep-alive connections from a pool of WGER_POOL_SIZE, failed requests and
+# 429/5xx responses are retried WGER_MAX_RETRIES times with exponential backoff
+
+_wger_session = None
+_wger_executor = None
+
+def get_wger_session():
+    global _wger_session
+    with _wger_lock:
+        if _wger_session is None:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retries = Retry(total=WGER_MAX_RETRIES, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+            adapter = HTTPAdapter(pool_connections=WGER_POOL_SIZE, pool_maxsize=WGER_POOL_SIZE, max_retries=retries)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _wger_session = session
+        return _wger_session
+
+
+#9.3.2 Function to return the thread pool used to run wger requests concurrently
+
+def get_wger_executor():
+    global _wger_executor
+    with _wger_lock:
+        if _wger_executor is None:
+            _wger_executor = ThreadPoolExecutor(max_workers=WGER_POOL_SIZE, thread_name_prefix='wger')
+        return _wger_executor
+
+
+#9.4 Function to load the wger mirror and index it by muscle name, muscle id and exercise base, returns None when there is no mirror yet
+
+_wger_mirror = None
+
+def load_wger_mirror():
+    global _wger_mirror
+    if not os.path.exists(WGER_MIRROR_FILE):
+        return None
+    stat = os.stat(WGER_MIRROR_FILE)
+    version = (stat.st_mtime_ns, stat.st_size)
+    if _wger_mirror is not None and _wger_mirror['version'] == version:
+        return _wger_mirror
+    
+    with open(WGER_MIRROR_FILE) as f:
+        mirror = json.load(f)
+    exercises_by_muscle = {}
+    for exercise in sorted(mirror['exercises'], key=lambda exercise: exercise['id']):
+        for muscle_id in exercise.get('muscles', []):
+            exercises_by_muscle.setdefault(muscle_id, []).append(exercise)
+    image_by_base = {}
+    for image in mirror['images']:
+        image_by_base.setdefault(image['exercise_base'], image['image'])
+    
+    _wger_mirror = {
+        'version': version,
+        'synced_at': mirror['synced_at'],
+        'muscles': {muscle['name_en']: muscle['id'] for muscle in mirror['muscles']},
+        'exercises_by_muscle': exercises_by_muscle,
+        'image_by_base': image_by_base
+    }
+    return _wger_mirror
+
+
+#9.5 Function to return the muscles as {english name: muscle id}
+
+def wger_muscles():
+    mirror = load_wger_mirror()
+    if mirror is not None:
+        return mirror['muscles']
+    return {muscle['name_en']: muscle['id'] for muscle in wger_get('muscle/')['results']}
+
+
+#9.6 Function to return the first k exercises (by id) for a muscle as dicts with name, description and image
+
+def wger_exercises(muscle_id, k=5):
+    mirror = load_wger_mirror()
+    if mirror is not None:
+        exercises = mirror['exercises_by_muscle'].get(muscle_id, [])[:k]
+        return [{'name': exercise['name'], 'description': exercise['description'], 'image': mirror['image_by_base'].get(exercise['exercise_base'])}
+                for exercise in exercises]
+    
+    # The image lookups are independent, so they all run at once on the shared pool
+    exercises = sorted(wger_get('exercise/', {'muscles': muscle_id, 'language': 2})['results'], key=lambda exercise: exercise['id'])[:k]
+    image_lookups = get_wger_executor().map(lambda exercise: wger_get('exerciseimage/', {'is_main': 'True', 'exercise_base': exercise['exercise_base']})['results'], exercises)
+    return [{'name': exercise['name'], 'description': exercise['description'], 'image': images[0]['image'] if images else None}
+            for exercise, images in zip(exercises, image_lookups)]
+
+
+#9.7 Function to run a local stand-in for the wger api, serving the mirror (or a small built in sample) with the same
+# filtering and paging as wger. Used for tests and benchmarks, e.g. ANYTIME_WGER_URL=http://localhost:8765/api/v2
+
+WGER_SAMPLE = {
+    'muscles': [{'id': 1, 'name': 'Biceps brachii', 'name_en': 'Biceps'}, {'id': 2, 'name': 'Anterior deltoid', 'name_en': 'Shoulders'},
+                {'id': 5, 'name': 'Triceps brachii', 'name_en': 'Triceps'}],
+    'exercises': [{'id': 74, 'name': 'Biceps Curls With Barbell', 'description': '<p>Hold the barbell shoulder-wide and curl it up.</p>', 'exercise_base': 74, 'muscles': [1], 'language': 2},
+                  {'id': 81, 'name': 'Hammer Curls', 'description': '<p>Curl the dumbbells with a neutral grip.</p>', 'exercise_base': 81, 'muscles': [1], 'language': 2},
+                  {'id': 119, 'name': 'Shoulder Press, Dumbbells', 'description': '<p>Press the dumbbells overhead.</p>', 'exercise_base': 119, 'muscles': [2], 'language': 2},
+                  {'id': 148, 'name': 'Lateral Raises', 'description': '<p>Raise the dumbbells to the side.</p>', 'exercise_base': 148, 'muscles': [2], 'language': 2},
+                  {'id': 163, 'name': 'Dips', 'description': '<p>Lower and push up between parallel bars.</p>', 'exercise_base': 163, 'muscles': [5], 'language': 2}],
+    'images': [{'id': 1, 'exercise_base': 74, 'image': 'https://wger.de/media/exercise-images/74/Bicep-curls-1.png', 'is_main': True},
+               {'id': 2, 'exercise_base': 119, 'image': 'https://wger.de/media/exercise-images/119/seated-dumbbell-shoulder-press-large-1.png', 'is_main': True}]
+}
+
+def run_fake_wger_server(port=8765):
+    data = WGER_SAMPLE
+    if os.path.exists(WGER_MIRROR_FILE):
+        with open(WGER_MIRROR_FILE) as f:
+            data = json.load(f)
+    endpoints = {'muscle': data['muscles'], 'exercise': data['exercises'], 'exerciseimage': data['images']}
+
+    class FakeWgerHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            endpoint = url.path.rstrip('/').split('/')[-1]
+            if endpoint not in endpoints:
+                self.send_error(404)
+                return
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            limit = int(query.pop('limit', 20))
+            offset = int(query.pop('offset', 0))
+            rows = endpoints[endpoint]
+            if 'muscles' in query:
+                rows = [row for row in rows if int(query['muscles']) in row.get('muscles', [])]
+            if 'language' in query:
+                rows = [row for row in rows if row.get('language') == int(query['language'])]
+            if 'exercise_base' in query:
+                rows = [row for row in rows if row.get('exercise_base') == int(query['exercise_base'])]
+            if 'is_main' in query:
+                rows = [row for row in rows if row.get('is_main') == (query['is_main'].lower() == 'true')]
+            next_url = None
+            if offset + limit < len(rows):
+                next_url = f"http://{self.headers['Host']}{url.path}?{urlencode(dict(query, limit=limit, offset=offset + limit))}"
+            body = json.dumps({'count': len(rows), 'next': next_url, 'previous': None, 'results': rows[offset:offset + limit]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer(('localhost', port), FakeWgerHandler)
+
+
+#9.8 Commands to refresh the wger mirror and to run the fake wger server, e.g. python insy660_merged_v4.py sync-wger
+
+def sync_wger_command(args):
+    mirror = sync_wger_mirror()
+    print(f"Mirrored {len(mirror['muscles'])} muscles, {len(mirror['exercises'])} exercises and {len(mirror['images'])} images from {WGER_BASE_URL} to {WGER_MIRROR_FILE}")
+
+def fake_wger_command(args):
+    port = int(args[0]) if args else 8765
+    server = run_fake_wger_server(port)
+    print(f"Fake wger api listening on http://localhost:{port}/api/v2 (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
 
 
 #10. Function to predict gym occupancy and recommend the best time for user to visit the gym based on lowest predicted occupancy
 
 def gym_occupancy():
-    df = pd.read_csv('gym_occupancy.csv')
-    gym_data = pd.read_excel('gym_data.xlsx')
-    gym_id = int(input("\nPlease enter your home gymId: "))
-    if gym_id in gym_data['gymId'].tolist():
-        var = input("\nWhen are you planning to go to the gym? ")
-        if var=='today':
-            req_date = datetime.now().date()
-        elif var =='tomorrow':
-            req_date = (datetime.now() + timedelta(days=1)).date()
+    table = load_occupancy_table()
+    while True:
+        gym_id = (yield "\nPlease enter your home gymId: ").strip()
+        if gym_id.isdigit() and int(gym_id) in table['index']:
+            gym_id = int(gym_id)
+            break
+        say("Sorry, you seem to have entered an incorrect gymId. Please try again")
+
+    var = (yield "\nWhen are you planning to go to the gym? ")
+    today = datetime.now().date()
+    tomorrow = today + timedelta(days=1)
+    
+    hours = []
+    if var=='today':
+        hours = best_hours(gym_id, today.weekday(), from_hour=datetime.now().hour)
+        if(len(hours)>0):
+            say("\nThe best time for you to visit the gym today is: ")
+            say(format_hours(hours))
         else:
-            req_date = datetime.now().date()
+            say("Sorry, there is no suitable time to visit the gym today")
         
-        df2 = pd.merge(df,gym_data[['gymId','capacity']],how='inner',on='gymId')
-        df2['occupancy'] = df2['number_people'] / df2['capacity']
-        #df2['hour'] = df2['hour'].astype(str) + 'hrs'
+    if len(hours)==0 and var in ['today', 'tomorrow']:
+        hours = best_hours(gym_id, tomorrow.weekday())
+        if(len(hours)>0):
+            say("\nThe best time for you to visit the gym tomorrow is: ")
+            say(format_hours(hours))
+    
+    elif var!='tomorrow' and var!='today':
+        say("\nThe best time for you to visit the gym on: \n")
+        for i in range(7):
+            say(calendar.day_name[i] + ': ' + format_hours(best_hours(gym_id, i)))
+
+
+#10.1 Function to fingerprint a data file - the hash is cached per (mtime, size) so unchanged files are not re-read
+
+_file_digests = {}
+
+def file_digest(path):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+#10.2 Function to fingerprint the occupancy training data together with the feature schema, a saved model is only reused if this matches
+
+def occupancy_fingerprint():
+    digest = hashlib.sha256()
+    digest.update(','.join(OCCUPANCY_FEATURES).encode())
+    digest.update(OCCUPANCY_MODEL_SCOPE.encode())
+    digest.update(OCCUPANCY_MODEL_BACKEND.encode())
+    digest.update(occupancy_data_version().encode())
+    digest.update(file_digest(GYM_DATA_FILE).encode())
+    return digest.hexdigest()
+
+
+#10.3 Function to train the occupancy model offline and save it to the model registry along with the data fingerprint
+# The model is a dict of OCCUPANCY_MODEL_BACKEND models keyed by partition (None for the network wide model) and the gymId -> partition
+# map. The 20% holdout of the train_test_split is used to report the error and fit time of every gym in OCCUPANCY_TRAINING_REPORT_FILE
+
+def train_occupancy_model():
+    fingerprint = occupancy_fingerprint()
+    train, test = occupancy_training_split()
+    
+    partition = occupancy_partitions(train, OCCUPANCY_MODEL_SCOPE)
+    start = datetime.now()
+    if partition is None:
+        # A single model uses every core itself
+        fits = [fit_occupancy_estimator(None, train, -1, OCCUPANCY_MODEL_BACKEND)]
+    else:
+        # Many small models, one process per model. The network wide model is the fallback for gyms without a partition
+        # Workers are spawned, not forked - training also runs on the server's background refresh thread, and forking a threaded
+        # process that has used OpenMP can hang the children
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        keys = train['gymId'].map(partition)
+        jobs = [(None, train)] + [(key, rows) for key, rows in train.groupby(keys)]
+        with ProcessPoolExecutor(max_workers=OCCUPANCY_TRAIN_WORKERS, mp_context=multiprocessing.get_context('spawn')) as pool:
+            fits = list(pool.map(fit_occupancy_estimator, *zip(*jobs), [1] * len(jobs), [OCCUPANCY_MODEL_BACKEND] * len(jobs)))
+    model = {'scope': OCCUPANCY_MODEL_SCOPE, 'backend': OCCUPANCY_MODEL_BACKEND, 'partition': partition,
+             'models': {key: estimator for key, estimator, seconds in fits}}
+    fit_seconds = {key: seconds for key, estimator, seconds in fits}
+    
+    test = test.assign(error=(predict_with_occupancy_model(model, test[OCCUPANCY_FEATURES]) - test['occupancy']).abs())
+    report = pd.DataFrame({
+        'train_groups': train.groupby('gymId').size(),
+        'test_groups': test.groupby('gymId').size(),
+        'holdout_mae': test.groupby('gymId').apply(lambda rows: np.average(rows['error'], weights=rows['count'])),
+    }).fillna({'train_groups': 0, 'test_groups': 0}).rename_axis('gymId').reset_index()
+    report['partition'] = report['gymId'].map(partition) if partition is not None else None
+    report['fit_seconds'] = report['partition'].map(lambda key: fit_seconds.get(key if key in fit_seconds else None))
+    report.to_csv(OCCUPANCY_TRAINING_REPORT_FILE, index=False)
+    
+    entry = {
+        'fingerprint': fingerprint,
+        'features': OCCUPANCY_FEATURES,
+        'scope': OCCUPANCY_MODEL_SCOPE,
+        'backend': OCCUPANCY_MODEL_BACKEND,
+        'trained_at': datetime.now(),
+        'train_seconds': (datetime.now() - start).total_seconds(),
+        'holdout_mae': float(np.average(test['error'], weights=test['count'])) if len(test) else None,
+        'model': model,
+        'report': report
+    }
+    # Write to a temporary file first so a half written model is never picked up
+    with atomic_file(OCCUPANCY_MODEL_FILE) as tmp_file, open(tmp_file, 'wb') as f:
+        pickle.dump(entry, f)
+    return entry
+
+
+#10.3.1 Function to split the occupancy training data 80/20 - one row per gym/month/day/hour with its mean number of people, weighted
+# by the number of readings behind it. This approximates training on the raw readings: the weighted split criteria and leaf means
+# match, but bootstrap resamples whole groups rather than readings and min_samples_leaf counts groups. The holdout is split by
+# group too, so its error is measured on gym/month/day/hour slots the model has not seen rather than on individual readings
+
+def occupancy_training_split():
+    from sklearn.model_selection import train_test_split
+
+    stats = load_occupancy_stats()
+    gym_data = load_data(GYM_DATA_FILE)
+    
+    df2 = pd.merge(stats.astype({'gymId': 'int64'}),gym_data[['gymId','capacity']],how='inner',on='gymId')
+    df2['occupancy'] = df2['mean_people'] / df2['capacity']
+    
+    train, test = train_test_split(df2, test_size=0.2, random_state=42)
+    return train, test
+
+
+#10.3.2 Function to fit one occupancy model of the given backend on the training groups of a partition, returns (partition, model,
+# fit seconds). Runs in a worker process when partitioned models are trained in parallel
+
+def fit_occupancy_estimator(key, train, n_jobs, backend):
+    start = datetime.now()
+    if backend == 'mean':
+        estimator = fit_mean_occupancy(train)
+    else:
+        if backend == 'forest':
+            from sklearn.ensemble import RandomForestRegressor
+            estimator = RandomForestRegressor(n_jobs=n_jobs)
+        elif backend == 'forest-lite':
+            from sklearn.ensemble import RandomForestRegressor
+            estimator = RandomForestRegressor(n_estimators=30, max_depth=12, min_samples_leaf=2, n_jobs=n_jobs)
+        elif backend == 'hgb':
+            from sklearn.ensemble import HistGradientBoostingRegressor
+            estimator = HistGradientBoostingRegressor(max_iter=200, random_state=42)
+        else:
+            raise ValueError(f"Unknown occupancy model backend '{backend}', expected one of {', '.join(OCCUPANCY_BACKENDS)}")
+        estimator.fit(train[OCCUPANCY_FEATURES], train['occupancy'], sample_weight=train['count'])
+        if 'n_jobs' in estimator.get_params():
+            estimator.set_params(n_jobs=1)
+    return key, estimator, (datetime.now() - start).total_seconds()
+
+
+#10.3.3 Functions for the 'mean' backend - the weighted mean occupancy per gym/day of week/hour, falling back to the network mean of
+# the day of week and hour, then to the overall mean, for slots without readings. Slots are encoded as gymId * 168 + day * 24 + hour
+# and looked up with a binary search over the sorted codes
+
+def occupancy_slot_codes(X):
+    return X['gymId'].to_numpy(dtype='int64') * 168 + X['day_of_week'].to_numpy(dtype='int64') * 24 + X['hour'].to_numpy(dtype='int64')
+
+def fit_mean_occupancy(train):
+    codes = occupancy_slot_codes(train)
+    weights = train['count'].to_numpy(dtype='float64')
+    totals = train['occupancy'].to_numpy(dtype='float64') * weights
+    unique_codes, positions = np.unique(codes, return_inverse=True)
+    slot_weights = np.bincount(codes % 168, weights=weights, minlength=168)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        by_slot = np.bincount(codes % 168, weights=totals, minlength=168) / slot_weights
+    return {'backend': 'mean', 'codes': unique_codes,
+            'means': np.bincount(positions, weights=totals) / np.bincount(positions, weights=weights),
+            'by_slot': by_slot, 'overall': float(totals.sum() / weights.sum()) if len(train) else 0.0}
+
+def predict_mean_occupancy(lookup, X):
+    codes = occupancy_slot_codes(X)
+    positions = np.searchsorted(lookup['codes'], codes).clip(max=max(len(lookup['codes']) - 1, 0))
+    found = lookup['codes'][positions] == codes if len(lookup['codes']) else np.zeros(len(codes), dtype=bool)
+    predictions = np.where(found, lookup['means'][positions] if len(lookup['codes']) else 0.0, lookup['by_slot'][codes % 168])
+    return np.where(np.isnan(predictions), lookup['overall'], predictions)
+
+def predict_with_estimator(estimator, X):
+    if isinstance(estimator, dict):
+        return predict_mean_occupancy(estimator, X)
+    return estimator.predict(X)
+
+
+#10.3.4 Function to map every gym to the partition its model is trained on - None for a single global model, the gym itself, or
+# a KMeans cluster of the gyms' average occupancy by day of week and hour
+
+def occupancy_partitions(groups, scope):
+    if scope == 'global':
+        return None
+    if scope == 'gym':
+        return {int(gym_id): int(gym_id) for gym_id in groups['gymId'].unique()}
+    if scope == 'cluster':
+        from sklearn.cluster import KMeans
+        profile = groups.pivot_table(index='gymId', columns=['day_of_week', 'hour'], values='occupancy', aggfunc='mean')
+        profile = profile.apply(lambda row: row.fillna(row.mean()), axis=1)
+        labels = KMeans(n_clusters=min(OCCUPANCY_CLUSTERS, len(profile)), n_init=10, random_state=42).fit_predict(profile.to_numpy())
+        return {int(gym_id): int(label) for gym_id, label in zip(profile.index, labels)}
+    raise ValueError(f"Unknown occupancy model scope '{scope}', expected global, gym or cluster")
+
+
+#10.4 Function to lazily load the occupancy model - uses the in-memory copy, then the saved model, and only retrains when the data has changed
+# With stale_ok a model trained on older readings is used as long as it has the current features, scope and backend
+# The statistics, model and table loaders share _occupancy_lock, so concurrent sessions wait for one rebuild instead of each starting their own
+
+_occupancy_model = None
+_occupancy_lock = threading.RLock()
+
+def occupancy_model_matches(entry, fingerprint, stale_ok):
+    if stale_ok:
+        return (entry.get('features') == OCCUPANCY_FEATURES and entry.get('scope') == OCCUPANCY_MODEL_SCOPE
+                and entry.get('backend') == OCCUPANCY_MODEL_BACKEND)
+    return entry.get('fingerprint') == fingerprint and entry.get('features') == OCCUPANCY_FEATURES
+
+def load_occupancy_model_entry(stale_ok=False):
+    global _occupancy_model
+    fingerprint = occupancy_fingerprint()
+    if _occupancy_model is not None and occupancy_model_matches(_occupancy_model, fingerprint, stale_ok):
+        return _occupancy_model
+    
+    with _occupancy_lock:
+        if _occupancy_model is not None and occupancy_model_matches(_occupancy_model, fingerprint, stale_ok):
+            return _occupancy_model
         
-        X = df2[['gymId', 'month', 'day_of_week', 'hour']]
-        y = df2['occupancy']
+        entry = None
+        if os.path.exists(OCCUPANCY_MODEL_FILE):
+            try:
+                with open(OCCUPANCY_MODEL_FILE, 'rb') as f:
+                    entry = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+                entry = None
         
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        if entry is None or not occupancy_model_matches(entry, fingerprint, stale_ok):
+            entry = train_occupancy_model()
         
-        model = RandomForestRegressor()
+        _occupancy_model = entry
+        return entry
+
+def load_occupancy_model():
+    return load_occupancy_model_entry()['model']
+
+
+#10.5 Command to train the occupancy model offline, e.g. python insy660_merged_v4.py train-occupancy
+
+def train_occupancy_command(args):
+    entry = train_occupancy_model()
+    report = entry['report']
+    print(f"Occupancy model saved to {OCCUPANCY_MODEL_FILE} (data fingerprint {entry['fingerprint'][:12]})")
+    print(f"Scope {entry['scope']}, backend {entry['backend']}: {len(entry['model']['models'])} models trained in {entry['train_seconds']:.1f} s, "
+          f"holdout mean absolute error {entry['holdout_mae']:.4f}")
+    print(f"Per gym holdout error and fit time saved to {OCCUPANCY_TRAINING_REPORT_FILE}, least accurate gyms:")
+    print(report.sort_values('holdout_mae', ascending=False).head(5).to_string(index=False))
+
+
+#10.6 Function to precompute the predicted occupancy of every gym for every day of the week between 7 am and 10 pm
+# The table records the fingerprint of the model it was predicted with, stale_ok builds it from the last saved model without retraining
+
+def build_occupancy_table(stale_ok=False):
+    model_entry = load_occupancy_model_entry(stale_ok)
+    model = model_entry['model']
+    gym_ids = load_gyms().index.tolist()
+    month = (datetime.now().date() + timedelta(days=7)).month
     
-        model.fit(X_train, y_train)
-        
-        days = 7
-        hours_per_day = 15  # From 7 am to 10 pm
-        new_data = pd.DataFrame(columns=['gymId', 'month', 'day_of_week', 'hour'])
-        
+    new_data = predict_occupancy(occupancy_prediction_grid(gym_ids, month=month), model)
+    table = new_data.astype({'gymId': 'uint16', 'month': 'uint8', 'day_of_week': 'uint8', 'hour': 'uint8', 'predicted_occupancy': 'float32'})
+    table = table.sort_values(by=['gymId', 'day_of_week', 'predicted_occupancy'], kind='stable').reset_index(drop=True)
     
-        for day in range(days):
-            for hour in range(hours_per_day):
-                new_data = new_data.append({'gymId': gym_id,'month': int((req_date + timedelta(days=days)).strftime("%m")),'day_of_week': day,'hour': 7 + hour}, ignore_index=True)
+    entry = {
+        'fingerprint': model_entry['fingerprint'],
+        'month': month,
+        'generated_at': datetime.now(),
+        'table': table
+    }
+    with atomic_file(OCCUPANCY_TABLE_FILE) as tmp_file, open(tmp_file, 'wb') as f:
+        pickle.dump(entry, f)
+    return entry
+
+
+#10.7 Function to index the occupancy table as gymId -> day of week -> [(hour, predicted occupancy)] sorted from quietest to busiest
+
+def index_occupancy_table(table):
+    index = {}
+    for row in table.itertuples(index=False):
+        index.setdefault(int(row.gymId), {}).setdefault(int(row.day_of_week), []).append((int(row.hour), float(row.predicted_occupancy)))
+    return index
+
+
+#10.8 Functions to load the occupancy table for the chatbot - the last table is served while it is for the coming forecast month and
+# younger than OCCUPANCY_TABLE_MAX_AGE. When readings arrived since its model was trained, a background thread retrains the model and
+# swaps in the new table (update-occupancy does the same from a scheduler), so a member never waits for a retrain. Only a missing or
+# expired table is built while the member waits, from the last saved model
+
+_occupancy_table = None
+_occupancy_refresh = None
+_occupancy_refresh_lock = threading.Lock()
+
+def occupancy_table_is_usable(entry):
+    return (entry.get('month') == (datetime.now().date() + timedelta(days=7)).month
+            and datetime.now() - entry.get('generated_at', datetime.min) < OCCUPANCY_TABLE_MAX_AGE)
+
+def read_occupancy_table():
+    if not os.path.exists(OCCUPANCY_TABLE_FILE):
+        return None
+    try:
+        with open(OCCUPANCY_TABLE_FILE, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+def install_occupancy_table(entry):
+    global _occupancy_table
+    entry['index'] = index_occupancy_table(entry['table'])
+    _occupancy_table = entry
+    return entry
+
+def load_occupancy_table():
+    entry = _occupancy_table
+    if entry is None or not occupancy_table_is_usable(entry):
+        with _occupancy_lock:
+            entry = _occupancy_table
+            if entry is None or not occupancy_table_is_usable(entry):
+                entry = read_occupancy_table()
+                if entry is None or not occupancy_table_is_usable(entry):
+                    entry = build_occupancy_table(stale_ok=True)
+                entry = install_occupancy_table(entry)
     
-        predicted_occupancy = model.predict(new_data)
-        new_data['predicted_occupancy'] = predicted_occupancy
-        
-        dfx = new_data.copy()
-      
-        if var=='today':
-            day_of_week = req_date.weekday()
-            hour = int(datetime.now().strftime("%H"))
-            dfx = new_data[(new_data['day_of_week']==day_of_week)&(new_data['hour']>=hour)]
-            if(len(dfx)>0):
-                dfx = dfx.sort_values(by='predicted_occupancy').head(5)
-                print("\nThe best time for you to visit the gym today is: ")
-                text = ''
-                for i in range(len(dfx)):
-                    if(dfx.iloc[i]['hour']<12):
-                        text+= f'''{dfx.iloc[i]['hour']} AM, '''
-                    elif(dfx.iloc[i]['hour']==12):
-                        text+= f'''{int(dfx.iloc[i]['hour'])} PM, '''
-                    else:
-                        text+= f'''{int(dfx.iloc[i]['hour'])-12} PM, '''
-                print(text[:-2])
-            else:
-                print("Sorry, there is no suitable time to visit the gym today")
-            
-        if len(dfx)==0 or var=='tomorrow':
-            day_of_week = req_date.weekday()
-            dfx = new_data[(new_data['day_of_week']==day_of_week)]
-            if(len(dfx)>0):
-                dfx = dfx.sort_values(by='predicted_occupancy').head(5)
-                print("\nThe best time for you to visit the gym tomorrow is: ")
-                text = ''
-                for i in range(len(dfx)):
-                    if(dfx.iloc[i]['hour']<12):
-                        text+= f'''{dfx.iloc[i]['hour']} AM, '''
-                    elif(dfx.iloc[i]['hour']==12):
-                        text+= f'''{int(dfx.iloc[i]['hour'])} PM, '''
-                    else:
-                        text+= f'''{int(dfx.iloc[i]['hour'])-12} PM, '''
-                print(text[:-2])
-        
-        elif len(dfx)==0 or (var!='tomorrow' and var!='today'):
-            print("\nThe best time for you to visit the gym on: \n")
-            for i in range(7):
-                dfx = new_data[new_data['day_of_week']==i]
-                dfx = dfx.sort_values(by='predicted_occupancy').head(5)
-                text = calendar.day_name[i] + ': '
-                for i in range(len(dfx)):
-                    if(dfx.iloc[i]['hour']<12):
-                        text+= f'''{dfx.iloc[i]['hour']} AM, '''
-                    elif(dfx.iloc[i]['hour']==12):
-                        text+= f'''{int(dfx.iloc[i]['hour'])} PM, '''
-                    else:
-                        text+= f'''{int(dfx.iloc[i]['hour'])-12} PM, '''
-                print(text[:-2])
+    if entry['fingerprint'] != occupancy_fingerprint():
+        start_occupancy_refresh()
+    return entry
+
+def refresh_occupancy_table():
+    with _occupancy_lock:
+        fingerprint = occupancy_fingerprint()
+        if _occupancy_table is not None and _occupancy_table['fingerprint'] == fingerprint:
+            return _occupancy_table
+        entry = read_occupancy_table()
+        if entry is None or entry.get('fingerprint') != fingerprint or not occupancy_table_is_usable(entry):
+            entry = build_occupancy_table()
+        return install_occupancy_table(entry)
+
+def occupancy_refresh_loop():
+    try:
+        refresh_occupancy_table()
+    except Exception:
+        # Keep serving the last table, the next chat turn that sees new readings starts another refresh
+        pass
+
+def start_occupancy_refresh():
+    global _occupancy_refresh
+    with _occupancy_refresh_lock:
+        if _occupancy_refresh is None or not _occupancy_refresh.is_alive():
+            _occupancy_refresh = threading.Thread(target=occupancy_refresh_loop, name='occupancy-refresh', daemon=True)
+            _occupancy_refresh.start()
+
+
+#10.9 Function to return the k quietest hours of a gym on a given day, optionally only from a given hour onwards
+
+def best_hours(gym_id, day_of_week, from_hour=0, k=5):
+    slots = load_occupancy_table()['index'].get(gym_id, {}).get(day_of_week, [])
+    return [hour for hour, occupancy in slots if hour >= from_hour][:k]
+
+
+#10.10 Function to format a list of hours as 12 hour clock text, e.g. [9, 13] -> "9 AM, 1 PM"
+
+def format_hours(hours):
+    text = ''
+    for hour in hours:
+        if(hour<12):
+            text+= f'''{hour} AM, '''
+        elif(hour==12):
+            text+= f'''{hour} PM, '''
+        else:
+            text+= f'''{hour-12} PM, '''
+    return text[:-2]
+
+
+#10.11 Command to rebuild the occupancy table, meant to be scheduled (e.g. nightly cron) so the chatbot always reads a fresh table
+
+def refresh_occupancy_table_command(args):
+    entry = build_occupancy_table()
+    print(f"Occupancy table saved to {OCCUPANCY_TABLE_FILE} ({len(entry['table'])} rows for month {entry['month']})")
+
+
+#10.12 Function to build the occupancy prediction grid as a Cartesian product of gymId x day x hour in one step
+# Without dates the grid covers one generic week (day_of_week 0-6) in the given month, with dates it covers each calendar date
+
+def occupancy_prediction_grid(gym_ids, month=None, dates=None, hours=range(7, 22)):
+    if dates is None:
+        keys = pd.MultiIndex.from_product([gym_ids, [month], range(7), hours], names=OCCUPANCY_FEATURES)
+        return keys.to_frame(index=False)
+    
+    keys = pd.MultiIndex.from_product([gym_ids, pd.DatetimeIndex(dates), hours], names=['gymId', 'date', 'hour'])
+    grid = keys.to_frame(index=False)
+    grid['month'] = grid['date'].dt.month
+    grid['day_of_week'] = grid['date'].dt.dayofweek
+    return grid
+
+
+#10.13 Function to predict the occupancy of a whole grid with one batched predict call per model - the rows of each partition are
+# predicted together, gyms without a model of their own use the network wide model
+
+def predict_occupancy(grid, model=None):
+    if model is None:
+        model = load_occupancy_model()
+    grid = grid.copy()
+    grid['predicted_occupancy'] = predict_with_occupancy_model(model, grid[OCCUPANCY_FEATURES])
+    return grid
+
+def predict_with_occupancy_model(model, X):
+    if model['partition'] is None:
+        return predict_with_estimator(model['models'][None], X)
+    rows_by_key = {}
+    for gym_id, positions in X.groupby('gymId').indices.items():
+        key = model['partition'].get(int(gym_id))
+        rows_by_key.setdefault(key if key in model['models'] else None, []).append(positions)
+    predictions = np.empty(len(X))
+    for key, parts in rows_by_key.items():
+        positions = np.concatenate(parts)
+        predictions[positions] = predict_with_estimator(model['models'][key], X.iloc[positions])
+    return predictions
+
+
+#10.14 Command to forecast every gym for every hour of the coming days, e.g. python insy660_merged_v4.py forecast-occupancy 30
+
+def forecast_occupancy_command(args):
+    days = int(args[0]) if args else 30
+    gym_ids = load_gyms().index.tolist()
+    dates = pd.date_range(datetime.now().date(), periods=days, freq='D')
+    forecast = predict_occupancy(occupancy_prediction_grid(gym_ids, dates=dates, hours=range(24)))
+    forecast.to_csv('occupancy_forecast.csv', index=False)
+    print(f"Forecast for {len(gym_ids)} gyms over {days} days saved to occupancy_forecast.csv ({len(forecast)} rows)")
+
+
+#10.15 Function to read the occupancy history in chunks of chunk_size rows with compact dtypes, so memory use depends on the chunk
+# size and not on the length of the history. Only the bytes from start to end are read (the whole file by default), the date
+# column is parsed to datetime64 one chunk at a time
+
+class FileRegion(io.RawIOBase):
+    def __init__(self, file, size):
+        self.file = file
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.file.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+def read_occupancy_chunks(path=OCCUPANCY_DATA_FILE, chunk_size=OCCUPANCY_CHUNK_ROWS, start=0, end=None):
+    with open(path, 'rb') as f:
+        columns = f.readline().decode().strip().split(',')
+        start = max(start, f.tell())
+        end = complete_lines_end(path) if end is None else end
+        if end <= start:
+            return
+        f.seek(start)
+        region = io.BufferedReader(FileRegion(f, end - start))
+        for chunk in pd.read_csv(region, header=None, names=columns, dtype=OCCUPANCY_DTYPES, chunksize=chunk_size):
+            chunk['date'] = pd.to_datetime(chunk['date'], format='ISO8601')
+            yield chunk
+
+
+#10.16 Functions to find where the complete lines of a growing csv end (a sensor may be half way through writing a line) and to
+# sign the bytes just before a position - the signature identifies the data without hashing the whole history
+
+def complete_lines_end(path):
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            block_start = max(0, end - OCCUPANCY_TAIL_BYTES)
+            f.seek(block_start)
+            newline = f.read(end - block_start).rfind(b'\n')
+            if newline >= 0:
+                return block_start + newline + 1
+            end = block_start
+    return 0
+
+def tail_signature(path, end):
+    with open(path, 'rb') as f:
+        f.seek(max(0, end - OCCUPANCY_TAIL_BYTES))
+        block = f.read(end - max(0, end - OCCUPANCY_TAIL_BYTES))
+    return hashlib.sha256(f'{end}:'.encode() + block).hexdigest()
+
+# The data version adds the file's mtime, so a correction of older readings that keeps the same length still changes it
+
+def occupancy_data_version(path=OCCUPANCY_DATA_FILE):
+    return f"{tail_signature(path, complete_lines_end(path))}:{os.stat(path).st_mtime_ns}"
+
+
+#10.17 Functions to reduce occupancy readings to their count, sum and sum of squares of number_people per gym/month/day/hour
+# Statistics of two parts of the history are combined by adding them, the mean and standard deviation are derived at the end
+
+OCCUPANCY_SUM_COLUMNS = ['count', 'people_sum', 'people_sum_sq']
+
+def aggregate_occupancy(chunk):
+    people = chunk['number_people'].astype('float64')
+    grouped = chunk.assign(people_sum=people, people_sum_sq=people * people).groupby(OCCUPANCY_FEATURES)
+    return grouped.agg(count=('people_sum', 'size'), people_sum=('people_sum', 'sum'), people_sum_sq=('people_sum_sq', 'sum'))
+
+def combine_occupancy_stats(stats, more):
+    if stats is None:
+        return more
+    return stats.add(more, fill_value=0)
+
+def finish_occupancy_stats(stats):
+    if stats is None:
+        stats = aggregate_occupancy(pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in OCCUPANCY_DTYPES.items()}))
+    stats = stats.reset_index().astype({**{feature: OCCUPANCY_DTYPES[feature] for feature in OCCUPANCY_FEATURES}, 'count': 'uint32'})
+    stats['mean_people'] = (stats['people_sum'] / stats['count']).astype('float32')
+    variance = (stats['people_sum_sq'] / stats['count'] - stats['mean_people'].astype('float64') ** 2).clip(lower=0)
+    stats['std_people'] = np.sqrt(variance).astype('float32')
+    return stats
+
+
+#10.18 Function to fold the readings between start and end of the csv into statistics (None to start from scratch), returns the
+# combined statistics, the number of readings folded and the latest reading date
+
+def fold_occupancy(stats, path, start, end, chunk_size=OCCUPANCY_CHUNK_ROWS):
+    totals = None if stats is None else stats.set_index(OCCUPANCY_FEATURES)[OCCUPANCY_SUM_COLUMNS]
+    rows = 0
+    last_date = None
+    for chunk in read_occupancy_chunks(path, chunk_size, start, end):
+        totals = combine_occupancy_stats(totals, aggregate_occupancy(chunk))
+        rows += len(chunk)
+        last_date = max(last_date, chunk['date'].max()) if last_date is not None else chunk['date'].max()
+    return finish_occupancy_stats(totals), rows, last_date
+
+
+#10.19 Function to ingest the whole occupancy history into the statistics cache, e.g. after old readings in the csv were corrected
+
+def ingest_occupancy(path=OCCUPANCY_DATA_FILE, chunk_size=OCCUPANCY_CHUNK_ROWS):
+    mtime = os.stat(path).st_mtime_ns
+    end = complete_lines_end(path)
+    stats, rows, last_date = fold_occupancy(None, path, 0, end, chunk_size)
+    save_occupancy_stats(stats, {'source': tail_signature(path, end), 'offset': end, 'mtime_ns': mtime, 'rows': rows,
+                                 'last_date': last_date.isoformat() if last_date is not None else None,
+                                 'last_update': {'mode': 'full', 'rows': rows}})
+    return stats
+
+
+#10.20 Function to bring the statistics cache up to date with the csv at a cost proportional to the new readings only
+#   append  - the bytes before the cached offset are unchanged, only the lines after it are read
+#   rotated - the csv was replaced by a file whose first reading is after the cached high-water mark (last_date), all of it is new
+#   full    - anything else (no cache, history rewritten), the whole csv is ingested again. This includes a csv written since the
+#             cache (new mtime) with the same length and tail, i.e. older readings corrected in place
+
+def update_occupancy_stats(path=OCCUPANCY_DATA_FILE, chunk_size=OCCUPANCY_CHUNK_ROWS):
+    meta = read_occupancy_stats_meta()
+    stats = None
+    if meta is not None and meta.get('file') == occupancy_stats_file() and 'offset' in meta:
+        try:
+            stats = read_occupancy_stats(meta['file'])
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            stats = None
+    if stats is None:
+        return ingest_occupancy(path, chunk_size)
+    
+    mtime = os.stat(path).st_mtime_ns
+    end = complete_lines_end(path)
+    if end == meta['offset'] and tail_signature(path, end) == meta['source'] and mtime == meta.get('mtime_ns'):
+        return stats
+    if end > meta['offset'] and tail_signature(path, meta['offset']) == meta['source']:
+        mode, start = 'append', meta['offset']
+    elif meta['last_date'] is not None and first_occupancy_date(path) > pd.Timestamp(meta['last_date']):
+        mode, start = 'rotated', 0
     else:
-        print("Sorry, you seem to have entered an incorrect gymId. Please try again")
-        gym_occupancy()        
+        return ingest_occupancy(path, chunk_size)
+    
+    stats, rows, last_date = fold_occupancy(stats, path, start, end, chunk_size)
+    if last_date is not None and meta['last_date'] is not None:
+        last_date = max(last_date, pd.Timestamp(meta['last_date']))
+    save_occupancy_stats(stats, {'source': tail_signature(path, end), 'offset': end, 'mtime_ns': mtime, 'rows': meta['rows'] + rows,
+                                 'last_date': last_date.isoformat() if last_date is not None else meta['last_date'],
+                                 'last_update': {'mode': mode, 'rows': rows}})
+    return stats
+
+def first_occupancy_date(path):
+    first = next(read_occupancy_chunks(path, chunk_size=1), None)
+    return first['date'].iloc[0] if first is not None else pd.Timestamp.max
+
+
+#10.21 Functions to write and read the statistics cache - Feather is written uncompressed so it can be memory mapped, the metadata
+# (csv signature and offset, number of readings, last reading) is kept next to it in OCCUPANCY_STATS_META_FILE
+
+def occupancy_stats_file():
+    return OCCUPANCY_STATS_FILE + ('.feather' if importlib.util.find_spec('pyarrow') else '.pkl')
+
+def save_occupancy_stats(stats, meta):
+    path = occupancy_stats_file()
+    with atomic_file(path) as tmp_file:
+        if path.endswith('.feather'):
+            stats.to_feather(tmp_file, compression='uncompressed')
+        else:
+            stats.to_pickle(tmp_file)
+    
+    with atomic_file(OCCUPANCY_STATS_META_FILE) as tmp_file, open(tmp_file, 'w') as f:
+        json.dump({**meta, 'file': path, 'groups': len(stats), 'updated_at': datetime.now().isoformat()}, f, indent=2)
+
+def read_occupancy_stats_meta():
+    try:
+        with open(OCCUPANCY_STATS_META_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def read_occupancy_stats(path):
+    if path.endswith('.feather'):
+        import pyarrow.feather as feather
+        return feather.read_table(path, memory_map=True).to_pandas()
+    return pd.read_pickle(path)
+
 
+#10.22 Function to lazily load the occupancy statistics - uses the in-memory copy while the csv is unchanged, otherwise folds the
+# new readings into the cache
 
-#11. Function to handle faqs based on free text input from user - using rule based matching to answer customer queries. 
+_occupancy_stats = None
+
+def load_occupancy_stats():
+    global _occupancy_stats
+    version = occupancy_data_version()
+    if _occupancy_stats is not None and _occupancy_stats['source'] == version:
+        return _occupancy_stats['stats']
     
-def gym_faq(question):
-    question=question.lower()
-    if ('all' in question or 'another' in question or 'any ' in question) and  ('gym ' or 'center' and 'anyfitness' in question):
-        print("Yes your access key will allow you access to all gyms at any location and can work out at any gym you choose. However, there is one exception. There is a 30-day delay on reciprocity when you initially begin your membership. So for the first 30 days it will work only in your home gym")
-    elif any(keyword in question for keyword in ['abroad', 'international', 'vacation', 'different country', 'outside Canada']):
-        print("Yes, globetrotter! When you are a part of the Anytime Fitness family, you can work out at gyms nationwide AND around the globe thanks to our worldwide club access. Think of it as a global membership plan.")
-    elif ('lost' in question or "can't find" in question or 'cannot find' in question or 'missing' in question or "don't know where" in question or 'misplaced' in question) and 'key' in question:
-        print("Oh no! If you’ve lost your key fob, contact your home club ASAP and they will help you purchase a replacement key, for a small fee.")
-    elif 'personal' in question and any(keyword in question for keyword in ['train', 'coach', 'specialist']):
-        print("Anytime Fitness has lots of training options available. Personal Training is offered in a one-on-one format lead by a certified personal trainer, providing a very personalized experience. Small group training is similar to personal training, only it’s more fun as there are typically 2-4 people in a session. Team workouts include 5+ people and provide accountability and an energy-filled atmosphere that keeps you motivated. Make sure to check with your local gym to learn more about personal and team training.")
-    elif any(keyword in question for keyword in ['shower', 'locker']):
-        print("Yes, we do! Making healthy happen should be as easy as possible and the option to take a quick shower after a workout is sometimes the difference between “I can work out” and “I can’t work out.” While all clubs have showers and bathrooms, not all locations offer lockers.")
-    elif 'wifi' in question:
-        print("While many Anytime Fitness locations offer Wifi in their club, it is up to the owner to make it available to members. Don’t hesitate to ask your local club if you do not find the login information readily posted. Each location has separate a Wifi password. Reach out to your local gym to find more information on Wifi availability!")
-    elif any(keyword in question for keyword in ['guest', 'visitor', 'friend']):
-        print("Yes! We do allow guests if you would like to bring a friend. Our guest policy requires that visitors come in during staffed hours after coordinating with the local gym’s staff. Think of staffed hours as guest hours because each guest is required to sign in for the safety of our members!")
-    elif any(keyword in question for keyword in ['child', 'kid', 'son', 'daughter', 'baby', 'toddler']):
-        print("Anytime fitness locations do not offer child care or day care. For that reason, our child policy does not allow for children to be present with their parent while working out unless the child is a member in our system and meets our minimum age requirements (which are set individually by each club!).")
-    elif any(keyword in question for keyword in ['age', 'old']):
-        print("While there isn’t a set age limit, each of our Anytime Fitness locations must comply with state laws on age requirements and age restrictions. Check in with your local gym to learn what the age policy is near you.")
+    with _occupancy_lock:
+        version = occupancy_data_version()
+        if _occupancy_stats is None or _occupancy_stats['source'] != version:
+            _occupancy_stats = {'source': version, 'stats': update_occupancy_stats()}
+        return _occupancy_stats['stats']
+
+
+#10.23 Commands to ingest the whole occupancy history, or only the readings added since the last run, into the statistics cache
+# e.g. python insy660_merged_v4.py ingest-occupancy 500000, or python insy660_merged_v4.py update-occupancy from a scheduler
+# update-occupancy then retrains the model and rebuilds the occupancy table if the readings changed
+
+def ingest_occupancy_command(args):
+    chunk_size = int(args[0]) if args else OCCUPANCY_CHUNK_ROWS
+    stats = ingest_occupancy(chunk_size=chunk_size)
+    meta = read_occupancy_stats_meta()
+    print(f"{meta['rows']} readings up to {meta['last_date']} reduced to {len(stats)} gym/month/day/hour groups in {meta['file']}")
+
+def update_occupancy_command(args):
+    chunk_size = int(args[0]) if args else OCCUPANCY_CHUNK_ROWS
+    before = read_occupancy_stats_meta()
+    stats = update_occupancy_stats(chunk_size=chunk_size)
+    meta = read_occupancy_stats_meta()
+    if before is not None and meta['updated_at'] == before.get('updated_at'):
+        print(f"Occupancy statistics are up to date ({meta['rows']} readings up to {meta['last_date']})")
     else:
-        print("I'm sorry, but I couldn't find an answer to your question.")        
+        print(f"Folded {meta['last_update']['rows']} new readings ({meta['last_update']['mode']}), {meta['rows']} readings up to "
+              f"{meta['last_date']} in {len(stats)} groups")
+    
+    # Retrain here rather than in the chatbot, a running server picks up the saved table on its next occupancy request
+    start = datetime.now()
+    entry = refresh_occupancy_table()
+    print(f"Occupancy table for month {entry['month']} is based on the model of data fingerprint {entry['fingerprint'][:12]} "
+          f"({(datetime.now() - start).total_seconds():.1f} s)")
+
+
+#10.24 Function to compare the occupancy model backends on the same 80/20 split of gym_occupancy.csv, one network wide model each
+#   holdout_mae        - mean absolute error of the predicted occupancy, weighted by readings
+#   rank_correlation   - Spearman correlation of predicted and actual hourly occupancy within each gym/month/day of the holdout
+#   quietest_hour_hit  - share of those days where the predicted quietest hour is the actual quietest hour
+#   predict_ms         - median latency of one chatbot request (15 hourly slots of one gym), table_seconds for every gym's table
+#   size_kib           - pickled size of the model
+
+def compare_occupancy_models(backends=OCCUPANCY_BACKENDS, repeats=50):
+    train, test = occupancy_training_split()
+    month = (datetime.now().date() + timedelta(days=7)).month
+    request_grid = occupancy_prediction_grid([int(train['gymId'].iloc[0])], month=month)[OCCUPANCY_FEATURES]
+    table_grid = occupancy_prediction_grid(load_gyms().index.tolist(), month=month)[OCCUPANCY_FEATURES]
+    
+    rows = []
+    for backend in backends:
+        key, estimator, fit_seconds = fit_occupancy_estimator(None, train, -1, backend)
+        predictions = predict_with_estimator(estimator, test[OCCUPANCY_FEATURES])
+        
+        latencies = []
+        for i in range(repeats):
+            start = datetime.now()
+            predict_with_estimator(estimator, request_grid)
+            latencies.append((datetime.now() - start).total_seconds())
+        start = datetime.now()
+        predict_with_estimator(estimator, table_grid)
+        table_seconds = (datetime.now() - start).total_seconds()
+        
+        rank_correlation, quietest_hour_hit = hour_ranking_scores(test, predictions)
+        rows.append({'backend': backend,
+                     'holdout_mae': float(np.average(np.abs(predictions - test['occupancy']), weights=test['count'])),
+                     'rank_correlation': rank_correlation,
+                     'quietest_hour_hit': quietest_hour_hit,
+                     'fit_seconds': fit_seconds,
+                     'predict_ms': float(np.median(latencies)) * 1000,
+                     'table_seconds': table_seconds,
+                     'size_kib': len(pickle.dumps(estimator)) / 1024})
+    return pd.DataFrame(rows)
+
+def hour_ranking_scores(test, predictions):
+    days = ['gymId', 'month', 'day_of_week']
+    frame = test[days + ['hour', 'occupancy']].assign(predicted=predictions).reset_index(drop=True)
+    frame = frame[frame.groupby(days)['hour'].transform('size') >= 3]
+    if frame.empty:
+        return None, None
+    grouped = frame.groupby(days)
+    ranks = frame.assign(actual_rank=grouped['occupancy'].rank(), predicted_rank=grouped['predicted'].rank())
+    correlation = ranks.groupby(days)[['actual_rank', 'predicted_rank']].apply(lambda day: day['actual_rank'].corr(day['predicted_rank']))
+    hits = frame.loc[grouped['occupancy'].idxmin(), 'hour'].to_numpy() == frame.loc[grouped['predicted'].idxmin(), 'hour'].to_numpy()
+    return float(correlation.mean()), float(hits.mean())
+
+
+#10.25 Command to write the backend comparison to OCCUPANCY_COMPARISON_FILE, e.g. python insy660_merged_v4.py compare-occupancy-models
+# or python insy660_merged_v4.py compare-occupancy-models mean hgb
+
+def compare_occupancy_models_command(args):
+    report = compare_occupancy_models(args or OCCUPANCY_BACKENDS)
+    report.to_csv(OCCUPANCY_COMPARISON_FILE, index=False)
+    print(report.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+    print(f"\nSaved to {OCCUPANCY_COMPARISON_FILE}, select a backend with ANYTIME_OCCUPANCY_MODEL_BACKEND")
+
+
+#11. Function to handle faqs based on free text input from user - the question is ranked against the FAQ knowledge base in FAQ_FILE
+# and the best answer is shown, followed by the related questions that also scored above FAQ_MIN_SCORE
+
+def gym_faq(question):
+    matches = faq_search(question)
+    if not matches:
+        say("I'm sorry, but I couldn't find an answer to your question.")
+        return
+    
+    say(matches[0][1]['answer'])
+    if len(matches) > 1:
+        say("\nYou may also want to know:")
+        for score, entry in matches[1:]:
+            say(f"- {entry['example']}")
+
+
+#11.1 Function to split text into search terms - lower case words without stop words, with plural 's' and 'ing' endings removed
+# so that "lockers" matches "locker" while "message" no longer matches "age". Domain words are dropped only when other terms remain
+
+def faq_terms(text):
+    terms = []
+    domain_terms = []
+    for word in re.findall(r"[a-z0-9]+", text.lower().replace("'", "").replace("’", "")):
+        if word in FAQ_STOP_WORDS:
+            continue
+        if len(word) > 5 and word.endswith('ing'):
+            word = word[:-3]
+        elif len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        (domain_terms if word in FAQ_DOMAIN_WORDS else terms).append(word)
+    return terms or domain_terms
+
+
+#11.2 Function to load the FAQ index - an inverted index of term -> [(entry, term count)] over the topic and example questions of
+# every entry, with the idf of each term and the entry lengths used by BM25. Rebuilt only when FAQ_FILE changes
+_faq_index = None
+_faq_lock = threading.Lock()
+
+def load_faq_index():
+    global _faq_index
+    stat = os.stat(FAQ_FILE)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _faq_lock:
+        if _faq_index is not None and _faq_index['version'] == version:
+            return _faq_index
+        
+        with open(FAQ_FILE, newline='', encoding='utf-8') as file:
+            entries = list(csv.DictReader(file))
+        postings = {}
+        lengths = []
+        for position, entry in enumerate(entries):
+            questions = [question.strip() for question in entry['questions'].split('|') if question.strip()]
+            entry['example'] = questions[0] if questions else entry['topic']
+            terms = faq_terms(' '.join(questions + [entry['topic'].replace('-', ' ')]))
+            lengths.append(len(terms))
+            for term, count in Counter(terms).items():
+                postings.setdefault(term, []).append((position, count))
+        
+        n = len(entries)
+        idf = {term: math.log(1 + (n - len(entry_counts) + 0.5) / (len(entry_counts) + 0.5)) for term, entry_counts in postings.items()}
+        _faq_index = {'version': version, 'entries': entries, 'postings': postings, 'idf': idf, 'lengths': lengths,
+                      'average_length': sum(lengths) / n if n else 0}
+        return _faq_index
+
+
+#11.3 Function to return the top k FAQ entries for a question as (BM25 score, entry), best first, leaving out entries below min_score
+# or below min_share of the question's maximum score - an entry matching every term with a saturated term count scores idf * (k1 + 1)
+# per term. Only the postings of the question's terms are scored, so a lookup does not slow down as the knowledge base grows
+
+def faq_search(question, k=FAQ_TOP_K, min_score=FAQ_MIN_SCORE, min_share=FAQ_MIN_SHARE):
+    index = load_faq_index()
+    scores = {}
+    max_score = 0.0
+    for term in set(faq_terms(question)):
+        max_score += index['idf'].get(term, 0.0) * (FAQ_BM25_K1 + 1)
+        for position, count in index['postings'].get(term, []):
+            length_norm = 1 - FAQ_BM25_B + FAQ_BM25_B * index['lengths'][position] / index['average_length']
+            scores[position] = scores.get(position, 0.0) + index['idf'][term] * count * (FAQ_BM25_K1 + 1) / (count + FAQ_BM25_K1 * length_norm)
+    best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+    return [(score, index['entries'][position]) for position, score in best if score >= max(min_score, min_share * max_score)]
 
 
 #12. Function to allow user to return to previous menu or exit after end of each flow - For NEW User
 
 def repeat_trigger_new_user_flow():
-    ip = input("\n\nEnter 1 - To return to previous menu\nEnter 2 - To exit\n\nPlease enter your choice (1/2): ")
+    ip = (yield "\n\nEnter 1 - To return to previous menu\nEnter 2 - To exit\n\nPlease enter your choice (1/2): ")
     if(ip=="1"):
-        new_user_options()
+        return new_user_options
     else:
-        print("Thank you for talking to us today. Have a nice day!")
+        say("Thank you for talking to us today. Have a nice day!")
 
 
 #13. Function to allow user to return to previous menu or exit after end of each flow - For EXISTING User
 
 def repeat_trigger_existing_user_flow(target_id):
-    ip = input("\n\nEnter 1 - To return to previous menu\nEnter 2 - To exit\n\nPlease enter your choice (1/2): ")
+    ip = (yield "\n\nEnter 1 - To return to previous menu\nEnter 2 - To exit\n\nPlease enter your choice (1/2): ")
     if(ip=="1"):
-        existing_user_options(target_id)
+        return partial(existing_user_options, target_id)
+    else:
+        say("Thank you for talking to us today. Have a nice day!")
+
+
+#13.1 Function to run the screens of a conversation - each screen is a flow returning the next screen, or None when the
+# conversation is over
+
+def run_screens(screen):
+    while screen is not None:
+        screen = yield from screen()
+
+
+#14. Conversation engine - every chat is a Session with its own state. The flows above are generators that yield a prompt
+# whenever they need an answer and call say() for everything they display, so any front end (the terminal, the http server,
+# the benchmarks) can drive many sessions side by side with start_session() and reply()
+
+_current_session = contextvars.ContextVar('current_session', default=None)
+
+class Session:
+    def __init__(self, flow, interactive=False):
+        self.id = uuid.uuid4().hex
+        self.flow = flow
+        self.interactive = interactive
+        self.customer_id = None
+        self.outbox = []
+        self.prompt = None
+        self.finished = False
+        self.last_active = datetime.now()
+        self.lock = threading.Lock()
+
+
+#14.1 Function to display text to the user of the current session, outside a session it prints like print()
+
+def say(*values):
+    text = ' '.join(str(value) for value in values)
+    session = _current_session.get()
+    if session is None:
+        print(text)
     else:
-        print("Thank you for talking to us today. Have a nice day!")
+        session.outbox.append(text)
+
+def current_session():
+    return _current_session.get()
+
+
+#14.2 Function to run a session's flow until it asks the next question or ends
+# An error inside a flow ends only that session, with the same apology the flows use
+
+def advance_session(session, answer):
+    token = _current_session.set(session)
+    try:
+        session.prompt = session.flow.send(answer)
+    except StopIteration:
+        session.prompt = None
+        session.finished = True
+    except Exception:
+        session.outbox.append("\nSorry, we encountered an internal error. Please try again.\n")
+        session.prompt = None
+        session.finished = True
+    finally:
+        _current_session.reset(token)
+        session.last_active = datetime.now()
+
+
+#14.3 Functions to start a session, answer its current prompt and collect what it displayed since the last call
+
+def start_session(interactive=False):
+    session = Session(conversation(), interactive)
+    with session.lock:
+        advance_session(session, None)
+    return session
+
+def reply(session, text):
+    with session.lock:
+        if not session.finished:
+            advance_session(session, text)
+
+def take_messages(session):
+    with session.lock:
+        messages = session.outbox
+        session.outbox = []
+    return messages
 
 
-#Start of Main function
+#Start of Main function - the conversation flow of one session
 
-print("Hello! Welcome to AnytimeAssistant, the chatbot for Anytime Fitness.")
+def conversation():
+    say("Hello! Welcome to AnytimeAssistant, the chatbot for Anytime Fitness.")
 
-user_data = pd.read_excel('user_data.xlsx')
+    response = (yield "\nAre you a new user, an existing user, or do you want to exit? (type 'new', 'existing', or 'exit'): ")
+
+    if response.lower() == 'new':
+        yield from run_screens(new_user_options)
+    elif response.lower() == 'existing':
+        while True:
+            target_id = (yield "\nPlease enter your customer id: ").lower()
+            if get_user_repository().exists(target_id):
+                current_session().customer_id = target_id
+                yield from run_screens(partial(existing_user_options, target_id))
+                break
+            else:
+                say("Sorry, you seem to have entered an invalid customer id. Please try again.")
+                continue
+
+    elif response.lower() == 'exit':
+        say("Thank you! Have a nice day.")
+    else:
+        say("We're sorry, we couldn't understand your response. Please type 'new', 'existing', or 'exit'.")
 
-response = input("\nAre you a new user, an existing user, or do you want to exit? (type 'new', 'existing', or 'exit'): ")
 
-if response.lower() == 'new':
-    new_user_options()
-elif response.lower() == 'existing':
+#15. Terminal front end - one interactive session on stdin/stdout
+
+def main():
+    if pending_emails(due_only=False):
+        start_mail_worker()
+    
+    session = start_session(interactive=True)
     while True:
-        target_id = input("\nPlease enter your customer id: ").lower()
-        if target_id in user_data['customerId'].tolist():
-            existing_user_options(target_id)
+        for message in take_messages(session):
+            print(message)
+        if session.finished:
             break
-        else:
-            print("Sorry, you seem to have entered an invalid customer id. Please try again.")
+        try:
+            answer = input(session.prompt)
+        except EOFError:
+            break
+        reply(session, answer)
+
+    # Give the mail worker a chance to deliver this session's confirmation emails, anything left stays spooled for next time
+    flush_mail_queue()
+
+
+#16. HTTP front end - an asyncio server holding many sessions at once, each request is one turn of one session
+#   POST   /sessions                {}               -> {"session_id", "messages", "prompt", "finished"}
+#   POST   /sessions/<id>/messages  {"text": "..."}  -> {"session_id", "messages", "prompt", "finished"}
+#   DELETE /sessions/<id>
+#   GET    /health                                   -> {"sessions": <open sessions>}
+# Flow steps can load models or files, so they run in the default thread pool instead of on the event loop
+
+_sessions = {}
+
+def session_response(session):
+    return {'session_id': session.id, 'messages': take_messages(session), 'prompt': session.prompt, 'finished': session.finished}
+
+async def route_request(method, path, body):
+    loop = asyncio.get_running_loop()
+    parts = [part for part in path.split('?')[0].split('/') if part]
+    if method == 'GET' and parts == ['health']:
+        return 200, {'sessions': len(_sessions)}
+    if method == 'POST' and parts == ['sessions']:
+        session = await loop.run_in_executor(None, start_session)
+        _sessions[session.id] = session
+        return 201, session_response(session)
+    if len(parts) >= 2 and parts[0] == 'sessions':
+        session = _sessions.get(parts[1])
+        if session is None:
+            return 404, {'error': 'Unknown or expired session'}
+        if method == 'DELETE' and len(parts) == 2:
+            del _sessions[session.id]
+            return 200, {'session_id': session.id, 'finished': True}
+        if method == 'POST' and parts[2:] == ['messages']:
+            try:
+                text = str(json.loads(body or b'{}').get('text', ''))
+            except (ValueError, AttributeError):
+                return 400, {'error': 'Body must be a JSON object like {"text": "..."}'}
+            await loop.run_in_executor(None, reply, session, text)
+            response = session_response(session)
+            if session.finished:
+                _sessions.pop(session.id, None)
+            return 200, response
+    return 404, {'error': 'Not found'}
+
+async def handle_connection(reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, version = request_line.decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if not 0 <= length <= MAX_REQUEST_BODY:
+                # The body is not read, so the connection cannot be reused
+                status, payload, keep_alive = 413, {'error': f'Request body must be at most {MAX_REQUEST_BODY} bytes'}, False
+            else:
+                body = await reader.readexactly(length)
+                status, payload = await route_request(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+            data = json.dumps(payload).encode()
+            writer.write(f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(data)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def expire_sessions():
+    while True:
+        await asyncio.sleep(60)
+        cutoff = datetime.now() - SESSION_IDLE_TIMEOUT
+        for session_id, session in list(_sessions.items()):
+            if session.last_active < cutoff:
+                _sessions.pop(session_id, None)
+
+async def serve(host='localhost', port=8080):
+    server = await asyncio.start_server(handle_connection, host, port, limit=1 << 16)
+    expiry = asyncio.create_task(expire_sessions())
+    print(f"AnytimeAssistant listening on http://{host}:{port} (Ctrl+C to stop)")
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            expiry.cancel()
+
+
+#16.1 Command to run the http front end, e.g. python insy660_merged_v4.py serve 8080
+
+def serve_command(args):
+    port = int(args[0]) if args else 8080
+    host = args[1] if len(args) > 1 else 'localhost'
+    if pending_emails(due_only=False):
+        start_mail_worker()
+    try:
+        asyncio.run(serve(host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+#17. Command to measure startup, e.g. python insy660_merged_v4.py startup-benchmark 15
+# Reports the time to the first prompt of a fresh process, the slowest modules imported at startup (from python -X importtime)
+# and what each heavy library costs when a flow first imports it, each measured in its own fresh process
+
+LAZY_MODULES = ['pandas', 'numpy', 'matplotlib.pyplot', 'sklearn.neighbors', 'sklearn.feature_extraction.text',
+                'sklearn.ensemble', 'nltk.sentiment.vader', 'requests', 'smtplib']
+
+STARTUP_PROBE = """
+import sys
+from datetime import datetime
+start = datetime.now()
+import {module} as chatbot
+session = chatbot.start_session()
+print((datetime.now() - start).total_seconds(), ','.join(sorted(name for name in chatbot.LAZY_MODULES if name in sys.modules)))
+"""
+
+IMPORT_PROBE = """
+from datetime import datetime
+start = datetime.now()
+import {module}
+print((datetime.now() - start).total_seconds())
+"""
+
+def run_probe(code):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    return result.stdout.split(), result.stderr
+
+def startup_benchmark_command(args):
+    top = int(args[0]) if args else 15
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    (first_prompt, *loaded), importtime = run_probe(STARTUP_PROBE.format(module=module))
+    
+    # -X importtime prints one line per module after its own imports, indented by depth: "import time: self | cumulative | name"
+    imports = []
+    pending = []
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
             continue
-        
-elif response.lower() == 'exit':
-    print("Thank you! Have a nice day.")
-else:
-    print("We're sorry, we couldn't understand your response. Please type 'new', 'existing', or 'exit'.")    
\ No newline at end of file
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == module:
+                imports = pending
+            pending = []
+        elif depth == 1:
+            pending.append((int(cumulative) / 1e6, name.strip()))
+    
+    print(f"Time to first prompt: {float(first_prompt):.3f} s")
+    print(f"Heavy libraries loaded before the first prompt: {loaded[0] if loaded else 'none'}")
+    print(f"\nSlowest imports at startup (top {top}):")
+    for seconds, name in sorted(imports, reverse=True)[:top]:
+        print(f"    {name:<40} {seconds:8.3f} s")
+    
+    print("\nCold import time of the lazily imported libraries:")
+    for name in LAZY_MODULES:
+        (seconds,), _ = run_probe(IMPORT_PROBE.format(module=name))
+        print(f"    {name:<40} {float(seconds):8.3f} s")
+
+
+#Commands to move members between user_data.xlsx and the configured user repository, e.g. python insy660_merged_v4.py export-users
+
+def import_users_command(args):
+    path = args[0] if args else USER_DATA_FILE
+    get_user_repository().import_excel(path)
+    print(f"Imported members from {path}")
+
+def export_users_command(args):
+    path = args[0] if args else USER_DATA_FILE
+    get_user_repository().export_excel(path)
+    print(f"Exported members to {path}")
+
+
+#Commands to deliver the mail spool once and print the delivery metrics, and to run the local SMTP sink
+
+def send_mail_command(args):
+    flush_mail_queue(timeout=int(args[0]) if args else 60)
+    print(json.dumps(mail_metrics(), indent=2))
+
+def mail_sink_command(args):
+    port = int(args[0]) if args else 8025
+    server = run_smtp_sink(port)
+    print(f"SMTP sink listening on localhost:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+#Offline commands that can be run instead of the chatbot
+
+commands = {
+    'train-occupancy': train_occupancy_command,
+    'refresh-occupancy-table': refresh_occupancy_table_command,
+    'forecast-occupancy': forecast_occupancy_command,
+    'ingest-occupancy': ingest_occupancy_command,
+    'update-occupancy': update_occupancy_command,
+    'compare-occupancy-models': compare_occupancy_models_command,
+    'import-users': import_users_command,
+    'export-users': export_users_command,
+    'nearest-gyms': nearest_gyms_command,
+    'assign-trainers': assign_trainers_command,
+    'sync-wger': sync_wger_command,
+    'fake-wger': fake_wger_command,
+    'send-mail': send_mail_command,
+    'mail-sink': mail_sink_command,
+    'serve': serve_command,
+    'startup-benchmark': startup_benchmark_command,
+    'nutrition-report': nutrition_report_command
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,20 @@
+"""
+ANYTIME ASSISTANT - SHARED TEST SETUP
+"""
+
+#The chatbot is a single script that reads its data files from the working directory, so the tests import it from the
+#repository root and run from there
+
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture(autouse=True)
+def repo_dir(monkeypatch):
+    monkeypatch.chdir(REPO_DIR)
+    return REPO_DIR
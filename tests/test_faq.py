@@ -0,0 +1,45 @@
+"""
+ANYTIME ASSISTANT - FAQ RETRIEVAL TESTS
+"""
+
+import pytest
+
+import insy660_merged_v4 as chatbot
+
+
+#1. Questions must reach the entry that answers them, including ones whose key words are also domain words (gym, location)
+
+@pytest.mark.parametrize('question, topic', [
+    ("Can I go to any gym?", 'access-all-gyms'),
+    ("Can I use my key at any location?", 'access-all-gyms'),
+    ("can I work out at another gym", 'access-all-gyms'),
+    ("can I visit a location in another country", 'travel-abroad'),
+    ("I misplaced my key", 'lost-key'),
+    ("Can I bring a friend?", 'guests'),
+    ("do you have lockers", 'showers-lockers'),
+    ("is there an age limit", 'age-limit'),
+])
+def test_best_answer(question, topic):
+    matches = chatbot.faq_search(question)
+    assert matches and matches[0][1]['topic'] == topic
+
+
+#2. "age" must not match inside "message" - the old substring chain answered this with the age policy
+
+def test_age_does_not_match_inside_message():
+    assert all(entry['topic'] != 'age-limit' for score, entry in chatbot.faq_search("can I send a message to the staff"))
+
+
+#3. Questions about no topic get no answer - the old `if 'gym ' or ...` condition was always true and answered everything
+
+@pytest.mark.parametrize('question', ["what time does the gym open", "gym", "how do I cancel my membership"])
+def test_unanswerable_question(question, capsys):
+    assert chatbot.faq_search(question) == []
+    chatbot.gym_faq(question)
+    assert "couldn't find an answer" in capsys.readouterr().out
+
+
+#4. Weak matches are not offered as related questions
+
+def test_no_weak_related_questions():
+    assert [entry['topic'] for score, entry in chatbot.faq_search("I misplaced my key")] == ['lost-key']
@@ -0,0 +1,85 @@
+"""
+ANYTIME ASSISTANT - EXERCISE RECOMMENDATION TESTS AGAINST THE FAKE WGER SERVER
+"""
+
+import threading
+
+import pytest
+
+import insy660_merged_v4 as chatbot
+
+
+#1. Fixtures - each test runs in an empty directory (so there is no wger_mirror.json unless the test syncs one) with empty
+# wger caches, and the fake wger server listens on a free port with WGER_BASE_URL pointing at it
+
+@pytest.fixture(autouse=True)
+def empty_wger_state(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(chatbot, '_wger_cache', {})
+    monkeypatch.setattr(chatbot, '_wger_mirror', None)
+
+@pytest.fixture
+def fake_wger(monkeypatch):
+    server = chatbot.run_fake_wger_server(0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(chatbot, 'WGER_BASE_URL', f"http://localhost:{server.server_address[1]}/api/v2")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+#2. Function to run the exercise flow in a session with the given answers, returns the session and everything it displayed
+
+def run_exercise_flow(answers):
+    session = chatbot.Session(chatbot.suggest_exercises())
+    chatbot.advance_session(session, None)
+    for answer in answers:
+        chatbot.advance_session(session, answer)
+    return session, '\n'.join(session.outbox)
+
+
+#3. Without a mirror the exercises come from the api, descriptions without html and exercises without an image say so
+
+def test_exercises_from_api(fake_wger):
+    session, output = run_exercise_flow(['biceps'])
+    assert session.finished
+    assert "recommended exercises to workout your Biceps" in output
+    assert "Exercise Name: Biceps Curls With Barbell" in output
+    assert "Description: Hold the barbell shoulder-wide and curl it up." in output
+    assert "Image: https://wger.de/media/exercise-images/74/Bicep-curls-1.png" in output
+    assert "Exercise Name: Hammer Curls" in output and "Image: Image not available" in output
+    assert "Shoulder Press" not in output
+
+
+#4. An unknown muscle is asked again in the same flow
+
+def test_unknown_muscle_is_asked_again(fake_wger):
+    session, output = run_exercise_flow(['quads', 'triceps'])
+    assert session.finished
+    assert output.count("invalid input") == 1
+    assert "Exercise Name: Dips" in output
+
+
+#5. With a synced mirror the flow gives the same answer without the api
+
+def test_exercises_from_mirror(fake_wger):
+    mirror = chatbot.sync_wger_mirror()
+    assert len(mirror['exercises']) == len(chatbot.WGER_SAMPLE['exercises'])
+    online = run_exercise_flow(['shoulders'])[1]
+    
+    fake_wger.shutdown()
+    chatbot._wger_cache.clear()
+    session, offline = run_exercise_flow(['shoulders'])
+    assert session.finished
+    assert offline == online
+    assert "Exercise Name: Shoulder Press, Dumbbells" in offline and "Exercise Name: Lateral Raises" in offline
+
+
+#6. When wger cannot be reached and there is no mirror, the flow apologises once and ends instead of starting over
+
+def test_unreachable_api_ends_flow(fake_wger):
+    fake_wger.shutdown()
+    fake_wger.server_close()
+    session, output = run_exercise_flow([])
+    assert session.finished
+    assert session.outbox == ["\nSorry, we encountered an internal error. Please try again.\n"]